@@ -1,12 +1,13 @@
 #include <despot/util/logging.h>
 #include <world_model.h>
 #include <context_pomdp.h>
+#include <algorithm>
 
 #include "ros/ros.h"
 #include <std_msgs/Int32.h>
 #include <std_msgs/Bool.h>
 #include <msg_builder/TrafficAgentArray.h>
-#include <msg_builder/AgentPathArray.h>
+#include <msg_builder/AgentStatePathArray.h>
 #include <msg_builder/Lanes.h>
 #include <msg_builder/Obstacles.h>
 #include <msg_builder/PomdpCmd.h>
@@ -72,10 +73,9 @@ bool WorldSimulator::Connect() {
 	pathSub_ = nh.subscribe("plan", 1, &WorldSimulator::RetrievePathCallBack,
 			this);
 
-	agent_sub_ = nh.subscribe("agent_array", 1,
-			&WorldSimulator::AgentArrayCallback, this);
-	agent_path_sub_ = nh.subscribe("agent_path_array", 1,
-			&WorldSimulator::AgentPathArrayCallback, this);
+	// Agent states of every crowd_processor tick arrive with the latest paths.
+	agent_state_path_sub_ = nh.subscribe("agent_state_path_array", 1,
+			&WorldSimulator::AgentStatePathArrayCallback, this);
 	logi << "Subscribers and Publishers created at the "
 			<< Globals::ElapsedTime() << "th second" << endl;
 
@@ -439,89 +439,84 @@ void CalBBExtents(AgentStruct& agent, std::vector<COORD>& bb,
 			agent.bb_extent_y);
 }
 
-void WorldSimulator::AgentArrayCallback(msg_builder::TrafficAgentArray data) {
+void WorldSimulator::AgentStatePathArrayCallback(
+		const msg_builder::AgentStatePathArray::ConstPtr& msg) {
+	const msg_builder::AgentStatePathArray& data = *msg;
 	double data_sec = data.header.stamp.sec;  // std_msgs::time
 	double data_nsec = data.header.stamp.nsec;
 	double data_time_sec = data_sec + data_nsec * 1e-9;
 	agents_time_stamp_ = data_time_sec;
+	// Paths come from the latest finished path job, which may be older than the states.
+	paths_time_stamp_ = data.paths_stamp.sec + data.paths_stamp.nsec * 1e-9;
 	DEBUG(
-			string_sprintf("receive %d agents at time %f", data.agents.size(),
-					Globals::ElapsedTime()));
+			string_sprintf("receive %d agent states and paths at time %f",
+					data.ids.size(), Globals::ElapsedTime()));
 
 	exo_agents_.clear();
-	for (msg_builder::TrafficAgent& agent : data.agents) {
-		std::string agent_type = agent.type;
-		int id = agent.id;
-		exo_agents_[id] = AgentStruct();
-		exo_agents_[id].id = id;
-		if (agent_type == "car")
-			exo_agents_[id].type = AgentType::car;
-		else if (agent_type == "bike")
-			exo_agents_[id].type = AgentType::car;
-		else if (agent_type == "ped")
-			exo_agents_[id].type = AgentType::ped;
+	worldModel.id_map_belief_reset.clear();
+	worldModel.id_map_paths.clear();
+	worldModel.id_map_num_paths.clear();
+
+	for (int i = 0; i < data.ids.size(); i++) {
+		int id = data.ids[i];
+		AgentStruct& agent = exo_agents_[id];
+		agent = AgentStruct();
+		agent.id = id;
+		if (data.types[i] == msg_builder::AgentStatePathArray::TYPE_CAR)
+			agent.type = AgentType::car;
+		else if (data.types[i] == msg_builder::AgentStatePathArray::TYPE_BIKE)
+			agent.type = AgentType::car;
+		else if (data.types[i] == msg_builder::AgentStatePathArray::TYPE_PED)
+			agent.type = AgentType::ped;
 		else
-			ERR(string_sprintf("Unsupported type %s", agent_type));
+			ERR(string_sprintf("Unsupported type %d", data.types[i]));
 
-		exo_agents_[id].pos = COORD(agent.pose.position.x,
-				agent.pose.position.y);
-		exo_agents_[id].vel = COORD(agent.vel.x, agent.vel.y);
-		exo_agents_[id].speed = exo_agents_[id].vel.Length();
-		exo_agents_[id].heading_dir = navposeToHeadingDir(agent.pose);
+		agent.pos = COORD(data.positions[2 * i], data.positions[2 * i + 1]);
+		agent.vel = COORD(data.velocities[2 * i], data.velocities[2 * i + 1]);
+		agent.speed = agent.vel.Length();
+		agent.heading_dir = data.headings[i];
 
 		std::vector<COORD> bb;
-		for (auto& corner : agent.bbox.points) {
-			bb.emplace_back(corner.x, corner.y);
+		for (int j = 8 * i; j < 8 * (i + 1); j += 2) {
+			bb.emplace_back(data.bbox_corners[j], data.bbox_corners[j + 1]);
+		}
+		CalBBExtents(agent, bb, agent.heading_dir);
+
+		assert(agent.bb_extent_x > 0);
+		assert(agent.bb_extent_y > 0);
+
+		if (agent.type == AgentType::ped)
+			agent.cross_dir = data.cross_dirs[i];
+
+		// Path candidates share prefixes: read each node once, then follow
+		// parent links back from every leaf.
+		int node_begin = data.agent_node_offsets[i];
+		int node_end = data.agent_node_offsets[i + 1];
+		std::vector<COORD> nodes;
+		nodes.reserve(node_end - node_begin);
+		for (int j = node_begin; j < node_end; j++)
+			nodes.emplace_back(data.node_points[2 * j], data.node_points[2 * j + 1]);
+
+		int leaf_begin = data.agent_leaf_offsets[i];
+		int leaf_end = data.agent_leaf_offsets[i + 1];
+		worldModel.id_map_belief_reset[id] = data.reset_intentions[i];
+		worldModel.id_map_num_paths[id] = leaf_end - leaf_begin;
+		std::vector<Path>& paths = worldModel.id_map_paths[id];
+		paths.reserve(leaf_end - leaf_begin);
+		for (int j = leaf_begin; j < leaf_end; j++) {
+			Path new_path;
+			for (int node = data.leaf_nodes[j]; node >= 0;
+					node = data.node_parents[node_begin + node])
+				new_path.push_back(nodes[node]);
+			std::reverse(new_path.begin(), new_path.end());
+			paths.emplace_back(new_path.Interpolate());
 		}
-		CalBBExtents(exo_agents_[id], bb, exo_agents_[id].heading_dir);
-
-		assert(exo_agents_[id].bb_extent_x > 0);
-		assert(exo_agents_[id].bb_extent_y > 0);
 	}
 
 	if (logging::level() >= logging::DEBUG)
 		worldModel.PrintPathMap();
 
 	SimulatorBase::agents_data_ready = true;
-}
-
-void WorldSimulator::AgentPathArrayCallback(msg_builder::AgentPathArray data) {
-	double data_sec = data.header.stamp.sec;  // std_msgs::time
-	double data_nsec = data.header.stamp.nsec;
-	double data_time_sec = data_sec + data_nsec * 1e-9;
-	paths_time_stamp_ = data_time_sec;
-	DEBUG(
-			string_sprintf("receive %d agent paths at time %f",
-					data.agents.size(), Globals::ElapsedTime()));
-
-	worldModel.id_map_belief_reset.clear();
-	worldModel.id_map_paths.clear();
-	worldModel.id_map_num_paths.clear();
-
-	for (msg_builder::AgentPaths& agent : data.agents) {
-		std::string agent_type = agent.type;
-		int id = agent.id;
-
-		auto it = exo_agents_.find(id);
-		if (it != exo_agents_.end()) {
-			if (agent_type == "ped")
-				exo_agents_[id].cross_dir = agent.cross_dirs[0];
-
-			worldModel.id_map_belief_reset[id] = agent.reset_intention;
-			worldModel.id_map_num_paths[id] = agent.path_candidates.size();
-			worldModel.id_map_paths[id] = std::vector<Path>();
-			for (auto& nav_path : agent.path_candidates) {
-				Path new_path;
-				for (auto& pose : nav_path.poses) {
-					new_path.emplace_back(pose.pose.position.x,
-							pose.pose.position.y);
-				}
-				new_path = new_path.Interpolate();
-				worldModel.id_map_paths[id].emplace_back(new_path);
-			}
-		}
-	}
-
 	SimulatorBase::agents_path_data_ready = true;
 }
 
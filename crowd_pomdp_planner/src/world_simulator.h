@@ -29,6 +29,7 @@
 #include <msg_builder/peds_info.h>
 #include <msg_builder/TrafficAgentArray.h>
 #include <msg_builder/AgentPathArray.h>
+#include <msg_builder/AgentStatePathArray.h>
 
 #include "std_msgs/Float32.h"
 #include <std_msgs/Bool.h>
@@ -57,7 +58,7 @@ private:
 	double last_acc_;
 
 	ros::Publisher cmdPub_;
-	ros::Subscriber ego_sub_, ego_dead_sub_, pathSub_, agent_sub_, agent_path_sub_;
+	ros::Subscriber ego_sub_, ego_dead_sub_, pathSub_, agent_state_path_sub_;
 
 	std::string map_location_;
 	int summit_port_;
@@ -89,8 +90,8 @@ public:
 	void EgoStateCallBack(const msg_builder::car_info::ConstPtr car);
 	void RetrievePathCallBack(const nav_msgs::Path::ConstPtr path);
 
-	void AgentArrayCallback(msg_builder::TrafficAgentArray data);
-	void AgentPathArrayCallback(msg_builder::AgentPathArray data);
+	void AgentStatePathArrayCallback(
+			const msg_builder::AgentStatePathArray::ConstPtr& data);
 
 };
 
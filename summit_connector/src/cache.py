@@ -0,0 +1,111 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    Bounded key-value store that evicts the least recently used entry once
+    capacity is reached. Keeps hit, miss and eviction counters.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            # Re-insert to mark as most recently used (OrderedDict in python2 has no move_to_end).
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            self.hits += 1
+            return value
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.entries.pop(key)
+        elif len(self.entries) >= self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate()
+        }
+
+
+class ExpiringStore(object):
+    '''
+    Per-key state that is forgotten once a key has not been written for
+    max_idle_ticks calls to tick(). The store never holds more than capacity
+    entries; the least recently written entry is evicted first.
+    '''
+
+    def __init__(self, max_idle_ticks, capacity):
+        self.max_idle_ticks = max_idle_ticks
+        self.capacity = capacity
+        self.entries = OrderedDict()  # key -> (last written tick, value), oldest first.
+        self.ticks = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def tick(self):
+        self.ticks += 1
+        while len(self.entries) > 0:
+            key = next(iter(self.entries))
+            if self.ticks - self.entries[key][0] <= self.max_idle_ticks:
+                break
+            del self.entries[key]
+            self.expirations += 1
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.entries.pop(key)
+        elif len(self.entries) >= self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.entries[key] = (self.ticks, value)
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'capacity': self.capacity,
+            'expirations': self.expirations,
+            'evictions': self.evictions
+        }
@@ -0,0 +1,110 @@
+'''
+Transfer of crowd local intentions to crowd_processor.
+
+A local intention is the tuple published by the crowd service for each agent:
+(id, 'Car' | 'Bicycle', SumoNetworkRoutePoint) or (id, 'People', SidewalkRoutePoint, orientation).
+
+LocalIntentionMirror reads the shared-memory intention table when one is
+configured and exists at startup (see intention_table.py). Otherwise it fetches
+the intentions over Pyro with the acquire/read/release calls. With use_deltas,
+it instead keeps a local copy up to date with one call per tick to a crowd
+service that exposes
+
+    get_local_intentions_since(version) -> (current version, changed intentions, removed ids, full)
+
+where full means changed holds every intention and the copy must be dropped first.
+'''
+
+import sys
+
+import rospy
+
+from intention_table import IntentionTableReader
+
+
+class LocalIntentionMirror(object):
+    '''
+    Local copy of the crowd service intentions, as a lookup from agent id to the
+    intention without its id (the layout crowd_processor used to rebuild every tick).
+    '''
+
+    def __init__(self, crowd_service, use_deltas=False, table_path=None, max_table_age=2.0):
+        self.crowd_service = crowd_service
+        self.version = -1
+        self.lookup = {}
+        self.use_deltas = use_deltas
+        self.last_num_changed = 0
+        self.table_path = table_path
+        self.table_reader = None
+        self.max_table_age = max_table_age
+        if table_path is not None:
+            self.open_table()
+
+    def update(self):
+        view = self.read_table()
+        if view is not None:
+            # Pyro mirror state is stale from now on; resync fully if we ever fall back.
+            self.version = -1
+            self.last_num_changed = len(view)
+            return view
+
+        if self.use_deltas:
+            try:
+                (version, changed, removed, full) = self.crowd_service.get_local_intentions_since(self.version)
+            except AttributeError:
+                # Configured, but the crowd service does not expose it; not asked again.
+                rospy.logwarn('[crowd_intentions.py] crowd service has no get_local_intentions_since; '
+                              'using full transfers')
+                self.use_deltas = False
+            else:
+                if full:
+                    self.lookup = {}
+                for intention in changed:
+                    self.lookup[intention[0]] = intention[1:]
+                for agent_id in removed:
+                    self.lookup.pop(agent_id, None)
+                self.version = version
+                self.last_num_changed = len(changed)
+                return self.lookup
+
+        self.crowd_service.acquire_local_intentions()
+        local_intentions = self.crowd_service.local_intentions
+        self.crowd_service.release_local_intentions()
+        self.lookup = {}
+        for x in local_intentions:
+            self.lookup[x[0]] = x[1:]
+        self.last_num_changed = len(local_intentions)
+        return self.lookup
+
+    def read_table(self):
+        if self.table_path is None:
+            return None
+        if self.table_reader is not None and self.table_reader.is_replaced():
+            # A restarted crowd service renamed a new table into place; map that one.
+            self.table_reader.close()
+            self.open_table()
+        if self.table_reader is None:
+            return None
+
+        # Checked before every read, the first included: a table left behind by a crowd service
+        # that is no longer writing is never used.
+        if not self.table_reader.is_fresh(self.max_table_age):
+            return None
+        return self.table_reader.read()
+
+    def open_table(self):
+        '''
+        Maps the table at table_path. If there is none, the table is not used again and
+        intentions come over Pyro.
+        '''
+        try:
+            self.table_reader = IntentionTableReader(self.table_path)
+        except (IOError, OSError, ValueError) as e:
+            rospy.logwarn('[crowd_intentions.py] cannot read intention table {} ({}); using Pyro'.format(
+                self.table_path, e))
+            self.table_reader = None
+            self.table_path = None
+            return
+        print('[crowd_intentions.py] reading intentions from {} (writer pid {}, started {:.0f})'.format(
+            self.table_path, self.table_reader.writer_pid, self.table_reader.writer_start_time))
+        sys.stdout.flush()
@@ -1,11 +1,17 @@
 #!/usr/bin/env python2
 
 from util import *
+from path_workers import PathWorkerPool, PathHorizon, pack_intention, expand_path_tree
+from cache import ExpiringStore
+from scheduler import TickScheduler
+from stage_timers import StageTimers
+from crowd_intentions import LocalIntentionMirror
+from intention_table import default_table_path
 import carla
+import math
 import sys
 
 import numpy as np
-from collections import defaultdict
 
 import rospy
 import tf
@@ -22,6 +28,12 @@ import time
 
 start_time = time.time()
 
+AGENT_STATE_PATH_TYPES = {
+    'car': msg_builder.msg.AgentStatePathArray.TYPE_CAR,
+    'bike': msg_builder.msg.AgentStatePathArray.TYPE_BIKE,
+    'ped': msg_builder.msg.AgentStatePathArray.TYPE_PED
+}
+
 Pyro4.config.SERIALIZERS_ACCEPTED.add('serpent')
 Pyro4.config.SERIALIZER = 'serpent'
 Pyro4.util.SerializerBase.register_class_to_dict(
@@ -65,10 +77,40 @@ class CrowdProcessor(Summit):
         super(CrowdProcessor, self).__init__()
         pyro_port = rospy.get_param('~pyro_port', '8100')
         self.crowd_service = Pyro4.Proxy('PYRO:crowdservice.warehouse@localhost:{}'.format(pyro_port))
+        # The shared-memory intention table is used if enabled and the crowd service writes one; Pyro otherwise.
+        use_intention_table = rospy.get_param('~use_intention_table', False)
+        self.local_intentions = LocalIntentionMirror(
+            self.crowd_service,
+            use_deltas=rospy.get_param('~use_intention_deltas', False),
+            table_path=rospy.get_param('~intention_table', default_table_path(pyro_port)) if use_intention_table else None)
         self.network_agents = []
         self.sidewalk_agents = []
         self.ego_car_info = None
-        self.topological_hash_map = defaultdict(lambda: None)  # TODO Expiry to prevent memory explosion.
+        self.agent_paths = {}  # id -> [path tree, cross dirs, reset intention not yet sent, root position, stamp] of the latest path job.
+        self.topological_hash_map = ExpiringStore(
+            max_idle_ticks=rospy.get_param('~intention_expiry_ticks', 50),
+            capacity=rospy.get_param('~intention_store_capacity', 10000))
+        # Path candidates are computed in worker processes (inline if ~path_workers is 0) on the
+        # latest snapshot, so agent_array keeps its rate when path generation falls behind.
+        self.path_workers = PathWorkerPool(
+            rospy.get_param('~path_workers', 2),
+            self.sumo_network,
+            self.sidewalk,
+            route_path_cache_size=rospy.get_param('~route_path_cache_size', 4096),
+            sidewalk_chain_resolution=rospy.get_param('~sidewalk_chain_resolution', 0.5),
+            max_path_candidates=rospy.get_param('~max_path_candidates', 8),  # 0 keeps every branch.
+            path_candidate_end_region=rospy.get_param('~path_candidate_end_region', 1.0),
+            path_horizon=PathHorizon(
+                horizon=rospy.get_param('~path_horizon', 20),
+                resolution=rospy.get_param('~path_resolution', 1.0),
+                # Adaptive: size each agent's path from its speed over the planner's look-ahead
+                # (search_depth 12 at CONTROL_FREQ 3 Hz is 4 s).
+                adaptive=rospy.get_param('~adaptive_path_horizon', False),
+                time_horizon=rospy.get_param('~planner_time_horizon', 4.0),
+                min_length=rospy.get_param('~min_path_length', 5.0)))
+        rospy.on_shutdown(self.path_workers.close)
+        self.last_cache_report = time.time()
+        self.stage_timers = StageTimers('crowd_processor')
 
         self.il_car_info_sub = rospy.Subscriber(
             '/ego_state',
@@ -88,11 +130,18 @@ class CrowdProcessor(Summit):
             '/agent_path_array',
             msg_builder.msg.AgentPathArray,
             queue_size=1)
+        # Agent states of each snapshot with the latest paths in flat arrays; the planner reads this topic.
+        self.agents_state_path_pub = rospy.Publisher(
+            '/agent_state_path_array',
+            msg_builder.msg.AgentStatePathArray,
+            queue_size=1)
+        self.publish_agent_path_array = rospy.get_param('~publish_agent_path_array', False)
 
         self.num_car = rospy.get_param('~num_car', 0)
         self.num_bike = rospy.get_param('~num_bike', 0)
         self.num_ped = rospy.get_param('~num_ped', 0)
         self.total_num_agents = self.num_car + self.num_bike + self.num_ped
+        self.report_map_load_times()
 
         # self.agents_ready_pub.publish(True)
 
@@ -110,6 +159,152 @@ class CrowdProcessor(Summit):
                                            color=carla.Color(color_i, 0, color_i, 0))
             last_loc = carla.Location(pos.x, pos.y, 0.1)
 
+    def poll_agent_paths(self):
+        done = self.path_workers.poll()
+        if done is None:
+            return
+        # Path expansion runs in the workers; record the slowest shard and the end-to-end latency.
+        self.stage_timers.record('path_expansion', self.path_workers.last_compute_time)
+        self.stage_timers.record('path_latency', self.path_workers.last_latency)
+        self.store_agent_paths(*done)
+
+    def store_agent_paths(self, context, results):
+        # Keep the paths of the finished job until the next one; they are sent with the agent
+        # states of every later snapshot. /agent_path_array, if enabled, goes out now.
+        (stamp, agent_states) = context
+        agent_paths = {}
+        agents_path_msg = msg_builder.msg.AgentPathArray()
+        failed = 0
+
+        for (actor_id, topological_hash, path_tree, cross_dirs) in results:
+            if path_tree is None:
+                # Its path shard failed: keep the previous paths and hash rather than sending none,
+                # which the planner would take as a reason to reset the agent's belief.
+                failed += 1
+                if actor_id in self.agent_paths:
+                    agent_paths[actor_id] = self.agent_paths[actor_id]
+                if actor_id in self.topological_hash_map:
+                    self.topological_hash_map.put(actor_id, self.topological_hash_map.get(actor_id))
+                continue
+
+            reset_intention = self.topological_hash_map.get(actor_id) is None or \
+                              self.topological_hash_map.get(actor_id) != topological_hash
+            self.topological_hash_map.put(actor_id, topological_hash)
+            # A reset not yet sent (the agent left the radius since) is kept until it is.
+            previous = self.agent_paths.get(actor_id)
+            (agent_type, actor_pos, _, _, _) = agent_states[actor_id]
+            # The tree is rooted at the position the paths were computed from, at the job's stamp.
+            agent_paths[actor_id] = [path_tree, cross_dirs, reset_intention or (previous is not None and previous[2]),
+                                     actor_pos, stamp]
+
+            if not self.publish_agent_path_array:
+                continue
+
+            agent_paths_tmp = msg_builder.msg.AgentPaths()
+            agent_paths_tmp.id = actor_id
+            agent_paths_tmp.type = agent_type
+            agent_paths_tmp.reset_intention = reset_intention
+            for positions in expand_path_tree(path_tree):
+                path_msg = Path()
+                path_msg.header.frame_id = 'map'
+                path_msg.header.stamp = stamp
+                for (x, y) in [actor_pos] + positions:
+                    pose_msg = PoseStamped()
+                    pose_msg.header.frame_id = 'map'
+                    pose_msg.header.stamp = stamp
+                    pose_msg.pose.position.x = x
+                    pose_msg.pose.position.y = y
+                    path_msg.poses.append(pose_msg)
+                # self.draw_path(path_msg)
+                agent_paths_tmp.path_candidates.append(path_msg)
+            agent_paths_tmp.cross_dirs = cross_dirs
+
+            agents_path_msg.agents.append(agent_paths_tmp)
+
+        self.agent_paths = agent_paths
+        if failed > 0:
+            print('[crowd_processor.py] {} agents kept their previous paths after a failed path shard'.format(failed))
+            sys.stdout.flush()
+
+        if self.publish_agent_path_array:
+            try:
+            	agents_path_msg.header.frame_id = 'map'
+            	agents_path_msg.header.stamp = stamp
+            	self.agents_path_pub.publish(agents_path_msg)
+            except Exception as e:
+            	print(e)
+
+    def publish_agent_state_paths(self, stamp, agent_states):
+        # States of this snapshot with the paths of the latest finished job; agents without paths
+        # yet are sent with no path candidates. paths_stamp is the snapshot time of the oldest
+        # paths sent, or this snapshot's if there are none.
+        agents_state_path_msg = msg_builder.msg.AgentStatePathArray()
+        # Built as lists and assigned once; uint8[] fields default to a byte string, not a list.
+        ids = []
+        types = []
+        positions_flat = []
+        headings = []
+        velocities = []
+        bbox_corners_flat = []
+        reset_intentions = []
+        agent_cross_dirs = []
+        agent_node_offsets = [0]
+        node_points = []
+        node_parents = []
+        agent_leaf_offsets = [0]
+        leaf_nodes = []
+        paths_stamp = stamp
+
+        for (actor_id, (agent_type, actor_pos, heading, velocity, bbox_corners)) in agent_states.items():
+            agent_path = self.agent_paths.get(actor_id)
+            if agent_path is None:
+                (path_tree, cross_dirs, reset_intention, root_pos) = (([], [], []), [], False, actor_pos)
+            else:
+                (path_tree, cross_dirs, reset_intention, root_pos, path_stamp) = agent_path
+                agent_path[2] = False
+                paths_stamp = min(paths_stamp, path_stamp)
+
+            ids.append(actor_id)
+            types.append(AGENT_STATE_PATH_TYPES[agent_type])
+            positions_flat.extend(actor_pos)
+            headings.append(heading)
+            velocities.extend(velocity)
+            bbox_corners_flat.extend(bbox_corners)
+            reset_intentions.append(reset_intention)
+            agent_cross_dirs.append(len(cross_dirs) > 0 and cross_dirs[0])
+            # Node 0 of the agent is its position at paths_stamp, and roots the path tree (parent -1 -> 0).
+            (positions, parents, leaves) = path_tree
+            node_points.extend(root_pos)
+            node_parents.append(-1)
+            for (position, parent) in zip(positions, parents):
+                node_points.extend(position)
+                node_parents.append(parent + 1)
+            leaf_nodes.extend(leaf + 1 for leaf in leaves)
+            agent_node_offsets.append(len(node_parents))
+            agent_leaf_offsets.append(len(leaf_nodes))
+
+        agents_state_path_msg.ids = ids
+        agents_state_path_msg.types = types
+        agents_state_path_msg.positions = positions_flat
+        agents_state_path_msg.headings = headings
+        agents_state_path_msg.velocities = velocities
+        agents_state_path_msg.bbox_corners = bbox_corners_flat
+        agents_state_path_msg.reset_intentions = reset_intentions
+        agents_state_path_msg.cross_dirs = agent_cross_dirs
+        agents_state_path_msg.agent_node_offsets = agent_node_offsets
+        agents_state_path_msg.node_points = node_points
+        agents_state_path_msg.node_parents = node_parents
+        agents_state_path_msg.agent_leaf_offsets = agent_leaf_offsets
+        agents_state_path_msg.leaf_nodes = leaf_nodes
+        agents_state_path_msg.paths_stamp = paths_stamp
+
+        try:
+        	agents_state_path_msg.header.frame_id = 'map'
+        	agents_state_path_msg.header.stamp = stamp
+        	self.agents_state_path_pub.publish(agents_state_path_msg)
+        except Exception as e:
+        	print(e)
+
     def update(self):
         end_time = rospy.Time.now()
         elapsed = (end_time - init_time).to_sec()
@@ -117,7 +312,12 @@ class CrowdProcessor(Summit):
         if not self.ego_car_info:
             return
 
-        if len(self.world.get_actors()) > self.total_num_agents / 1.2 or time.time() -start_time > 15.0:
+        t = time.time()
+        snapshot = self.update_snapshot()
+        self.topological_hash_map.tick()
+        t = self.stage_timers.lap('snapshot', t)
+
+        if snapshot.num_actors > self.total_num_agents / 1.2 or time.time() -start_time > 15.0:
             # print("[crowd_processor.py] {} crowd agents ready".format(
                 # len(self.world.get_actors())))
             self.agents_ready_pub.publish(True)
@@ -132,150 +332,83 @@ class CrowdProcessor(Summit):
             ego_car_position.y)
 
         agents_msg = msg_builder.msg.TrafficAgentArray()
-        agents_path_msg = msg_builder.msg.AgentPathArray()
 
         current_time = rospy.Time.now()
 
-        self.crowd_service.acquire_local_intentions()
-        local_intentions = self.crowd_service.local_intentions
-        self.crowd_service.release_local_intentions()
-        local_intentions_lookup = {}
+        local_intentions_lookup = self.local_intentions.update()
+        t = self.stage_timers.lap('intention_fetch', t)
 
-        for x in local_intentions:
-            local_intentions_lookup[x[0]] = x[1:]
+        intentions = []
+        agent_states = {}  # id -> (agent type, position, heading, velocity, bbox corners) at this snapshot.
 
-        for actor in self.world.get_actors():
-            if not actor.id in local_intentions_lookup:
+        # TODO Add 50 as ROS parameter.
+        for actor_id in snapshot.ids[snapshot.query_radius(ego_car_position, 50)].tolist():
+            if not actor_id in local_intentions_lookup:
                 continue
-            if actor is None:
-                continue
-
-            local_intention = local_intentions_lookup[actor.id]
 
-            actor_pos = carla.Vector2D(actor.get_location().x, actor.get_location().y)
+            local_intention = local_intentions_lookup[actor_id]
 
-            if (actor_pos - ego_car_position).length() > 50:  # TODO Add as ROS parameter.
-                continue
+            actor_location = snapshot.get_location(actor_id)
 
             agent_tmp = msg_builder.msg.TrafficAgent()
             agent_tmp.last_update = current_time
-            agent_tmp.id = actor.id
+            agent_tmp.id = actor_id
             agent_tmp.type = {'Car': 'car', 'Bicycle': 'bike', 'People': 'ped'}[local_intention[0]]
-            agent_tmp.pose.position.x = actor.get_location().x
-            agent_tmp.pose.position.y = actor.get_location().y
-            agent_tmp.pose.position.z = actor.get_location().z
-            agent_tmp.vel.x = actor.get_velocity().x
-            agent_tmp.vel.y = actor.get_velocity().y
+            agent_tmp.pose.position.x = actor_location.x
+            agent_tmp.pose.position.y = actor_location.y
+            agent_tmp.pose.position.z = actor_location.z
+            actor_velocity = snapshot.get_velocity(actor_id)
+            agent_tmp.vel.x = actor_velocity.x
+            agent_tmp.vel.y = actor_velocity.y
             quat_tf = tf.transformations.quaternion_from_euler(
                 0, 0,
-                np.deg2rad(actor.get_transform().rotation.yaw))
+                np.deg2rad(snapshot.get_yaw(actor_id)))
             agent_tmp.pose.orientation = Quaternion(quat_tf[0], quat_tf[1], quat_tf[2], quat_tf[3])
 
             agent_tmp.bbox = Polygon()
-            corners = get_bounding_box_corners(actor, expand=0.3)
+            corners = snapshot.get_bounding_box_corners(actor_id, expand=0.3)
             for corner in corners:
                 agent_tmp.bbox.points.append(Point32(
                     x=corner.x, y=corner.y, z=0.0))
 
             agents_msg.agents.append(agent_tmp)
 
-            agent_paths_tmp = msg_builder.msg.AgentPaths()
-            agent_paths_tmp.id = actor.id
-            agent_paths_tmp.type = {'Car': 'car', 'Bicycle': 'bike', 'People': 'ped'}[local_intention[0]]
-
-            if local_intention[0] in ['Car', 'Bicycle']:
-                initial_route_point = carla.SumoNetworkRoutePoint()
-                initial_route_point.edge = local_intention[1].edge
-                initial_route_point.lane = local_intention[1].lane
-                initial_route_point.segment = local_intention[1].segment
-                initial_route_point.offset = local_intention[1].offset
-
-                paths = [[initial_route_point]]
-                topological_hash = ''
-
-                # TODO Add 20, 1.0 as ROS paramters.
-                for _ in range(20):
-                    next_paths = []
-                    for path in paths:
-                        next_route_points = self.sumo_network.get_next_route_points(path[-1], 1.0)
-                        next_paths.extend(path + [route_point] for route_point in next_route_points)
-                        if len(next_route_points) > 1:
-                            topological_hash += '({},{},{},{}={})'.format(
-                                path[-1].edge, path[-1].lane, path[-1].segment, path[-1].offset,
-                                len(next_route_points))
-                    paths = next_paths
-
-                agent_paths_tmp.reset_intention = self.topological_hash_map[actor.id] is None or \
-                                                  self.topological_hash_map[actor.id] != topological_hash
-                for path in paths:
-                    path_msg = Path()
-                    path_msg.header.frame_id = 'map'
-                    path_msg.header.stamp = current_time
-                    for path_point in [actor_pos] + \
-                            [self.sumo_network.get_route_point_position(route_point) for route_point in path]:
-                        pose_msg = PoseStamped()
-                        pose_msg.header.frame_id = 'map'
-                        pose_msg.header.stamp = current_time
-                        pose_msg.pose.position.x = path_point.x
-                        pose_msg.pose.position.y = path_point.y
-                        path_msg.poses.append(pose_msg)
-                    # self.draw_path(path_msg)
-                    agent_paths_tmp.path_candidates.append(path_msg)
-                agent_paths_tmp.cross_dirs = []
-                self.topological_hash_map[actor.id] = topological_hash
-
-            elif local_intention[0] == 'People':
-                sidewalk_route_point = carla.SidewalkRoutePoint()
-                sidewalk_route_point.polygon_id = local_intention[1].polygon_id
-                sidewalk_route_point.segment_id = local_intention[1].segment_id
-                sidewalk_route_point.offset = local_intention[1].offset
-                sidewalk_route_orientation = local_intention[2]
-
-                path = [sidewalk_route_point]
-                for _ in range(20):
-                    if sidewalk_route_orientation:
-                        path.append(self.sidewalk.get_next_route_point(path[-1], 1.0))  # TODO Add as ROS parameter.
-                    else:
-                        path.append(self.sidewalk.get_previous_route_point(path[-1], 1.0))  # TODO Add as ROS parameter.
-                topological_hash = '{},{}'.format(sidewalk_route_point.polygon_id, sidewalk_route_orientation)
-
-                agent_paths_tmp.reset_intention = self.topological_hash_map[actor.id] is None or \
-                                                  self.topological_hash_map[actor.id] != topological_hash
-                path_msg = Path()
-                path_msg.header.frame_id = 'map'
-                path_msg.header.stamp = current_time
-                for path_point in [actor_pos] + [self.sidewalk.get_route_point_position(route_point) for route_point in
-                                                 path]:
-                    pose_msg = PoseStamped()
-                    pose_msg.header.frame_id = 'map'
-                    pose_msg.header.stamp = current_time
-                    pose_msg.pose.position.x = path_point.x
-                    pose_msg.pose.position.y = path_point.y
-                    path_msg.poses.append(pose_msg)
-                # self.draw_path(path_msg)
-                agent_paths_tmp.path_candidates = [path_msg]
-                agent_paths_tmp.cross_dirs = [sidewalk_route_orientation]
-                self.topological_hash_map[actor.id] = topological_hash
+            intentions.append(pack_intention(
+                actor_id, local_intention, math.hypot(actor_velocity.x, actor_velocity.y)))
+            heading = np.deg2rad(snapshot.get_yaw(actor_id))
+            agent_states[actor_id] = (
+                agent_tmp.type,
+                (actor_location.x, actor_location.y),
+                math.atan2(math.sin(heading), math.cos(heading)),
+                (actor_velocity.x, actor_velocity.y),
+                [v for corner in corners for v in (corner.x, corner.y)])
 
-            agents_path_msg.agents.append(agent_paths_tmp)
+        t = self.stage_timers.lap('message_build', t)
 
         try:
         	agents_msg.header.frame_id = 'map'
         	agents_msg.header.stamp = current_time
         	self.agents_pub.publish(agents_msg)
-
-        	agents_path_msg.header.frame_id = 'map'
-        	agents_path_msg.header.stamp = current_time
-        	self.agents_path_pub.publish(agents_path_msg)
         except Exception as e:
         	print(e)
-
-        # self.do_update = False
-        end_time = rospy.Time.now()
-        elapsed = (end_time - init_time).to_sec()
-        # print('agent_array update = {} ms = {} hz'.format(duration * 1000, 1.0 / duration))
-        # print('agent_array update at {}'.format(elapsed))
-        # sys.stdout.flush()
+        t = self.stage_timers.lap('publish', t)
+
+        # Take in a finished path job and publish this snapshot's states with the latest paths,
+        # then start a job on this snapshot if the workers are free.
+        self.poll_agent_paths()
+        self.publish_agent_state_paths(current_time, agent_states)
+        t = self.stage_timers.lap('path_publish', t)
+        if not self.path_workers.busy():
+            self.path_workers.submit(intentions, (current_time, agent_states))
+            self.stage_timers.lap('path_submit', t)
+            self.poll_agent_paths()
+
+        if time.time() - self.last_cache_report > 10.0:
+            stats = self.topological_hash_map.stats()
+            print('[crowd_processor.py] intention store: size={} expirations={} evictions={}'.format(
+                stats['size'], stats['expirations'], stats['evictions']))
+            sys.stdout.flush()
+            self.last_cache_report = time.time()
 
 
 if __name__ == '__main__':
@@ -283,7 +416,9 @@ if __name__ == '__main__':
     init_time = rospy.Time.now()
     crowd_processor = CrowdProcessor()
 
-    rate = rospy.Rate(10)
-    while not rospy.is_shutdown():
-        crowd_processor.update()
-        rate.sleep()
+    # agent_array rate; path jobs run alongside and their paths are sent from the tick they finish.
+    scheduler = TickScheduler('crowd_processor.py', report_period=rospy.get_param('~scheduler_report_period', 10.0))
+    scheduler.add_task('update', lambda event: crowd_processor.update(), rospy.get_param('~agent_array_rate', 10), priority=1)
+    scheduler.add_task('diagnostics', lambda event: crowd_processor.stage_timers.publish(scheduler),
+                       rospy.get_param('~diagnostics_rate', 1.0), skippable=True)
+    scheduler.run()
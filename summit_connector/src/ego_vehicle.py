@@ -1,9 +1,13 @@
 #!/usr/bin/env python2
 
 from summit import Summit
+from scheduler import TickScheduler
+from stage_timers import StageTimers
+from world_snapshot import get_box_corners
 import carla
 
 import random
+from collections import deque, namedtuple
 import math
 import numpy as np
 import sys
@@ -52,12 +56,46 @@ Pyro4.util.SerializerBase.register_dict_to_class(
 
 ''' ========== UTILITY FUNCTIONS AND CLASSES ========== '''
 
+# Static geometry of a vehicle, read once after spawn. Axle centres are wheel positions in world
+# coordinates at that time, not offsets from the actor; purepursuit_controller only uses their
+# distances to each other and to car_pos in the initial ego_state. The bounding box location is
+# the (x, y) offset of its centre from the actor and its extent the (x, y) half lengths.
+VehicleGeometry = namedtuple(
+    'VehicleGeometry', 'front_axle_center rear_axle_center max_steer_angle steer_angle_range bbox_location bbox_extent')
+
+
+def get_vehicle_geometry(actor):
+    '''
+    Reads the physics control and bounding box of actor once; they do not change after spawn.
+    '''
+    wheels = actor.get_physics_control().wheels
+    bbox = actor.bounding_box
+    # TODO I think that CARLA might have forgotten to divide by 100 here.
+    wheel_positions = [w.position / 100 for w in wheels]
+
+    return VehicleGeometry(
+        front_axle_center=(wheel_positions[0] + wheel_positions[1]) / 2,
+        rear_axle_center=(wheel_positions[2] + wheel_positions[3]) / 2,
+        max_steer_angle=wheels[0].max_steer_angle,
+        steer_angle_range=(wheels[0].max_steer_angle + wheels[1].max_steer_angle) / 2,
+        bbox_location=(bbox.location.x, bbox.location.y),
+        bbox_extent=(bbox.extent.x, bbox.extent.y))
+
+
 class NetworkAgentPath:
-    def __init__(self, sumo_network, min_points, interval):
+    '''
+    Route points of the ego vehicle's path, in a deque, with their positions
+    cached in an (n, 2) array. Positions are converted once when points are
+    appended; cut drops from the front of both.
+    '''
+
+    def __init__(self, sumo_network, min_points, interval, route_points=()):
         self.sumo_network = sumo_network
         self.min_points = min_points
         self.interval = interval
-        self.route_points = []
+        self.route_points = deque()
+        self.positions = np.zeros((0, 2))
+        self.extend(route_points)
 
     @staticmethod
     def rand_path(sumo_network, min_points, interval, segment_map, min_safe_points=None, rng=random):
@@ -71,55 +109,157 @@ class NetworkAgentPath:
             spawn_point = sumo_network.get_nearest_route_point(spawn_point)
             route_paths = sumo_network.get_next_route_paths(spawn_point, min_safe_points - 1, interval)
 
-        path = NetworkAgentPath(sumo_network, min_points, interval)
-        path.route_points = rng.choice(route_paths)[0:min_points]
-        return path
+        return NetworkAgentPath(sumo_network, min_points, interval, rng.choice(route_paths)[0:min_points])
+
+    def extend(self, route_points):
+        if len(route_points) == 0:
+            return
+        self.route_points.extend(route_points)
+        positions = [self.sumo_network.get_route_point_position(p) for p in route_points]
+        self.positions = np.concatenate((self.positions, [(p.x, p.y) for p in positions]))
 
     def resize(self, rng=random):
-        while len(self.route_points) < self.min_points:
-            next_points = self.sumo_network.get_next_route_points(self.route_points[-1], self.interval)
+        new_points = []
+        last_point = self.route_points[-1]
+        while len(self.route_points) + len(new_points) < self.min_points:
+            next_points = self.sumo_network.get_next_route_points(last_point, self.interval)
             if len(next_points) == 0:
+                self.extend(new_points)
                 return False
-            self.route_points.append(rng.choice(next_points))
+            last_point = rng.choice(next_points)
+            new_points.append(last_point)
+        self.extend(new_points)
         return True
 
+    def get_offsets(self, position):
+        '''
+        Distances from position to the points in the first half of the path.
+        '''
+        d = self.positions[0:len(self.route_points) // 2] - (position.x, position.y)
+        return np.sqrt((d ** 2).sum(axis=1))
+
     def get_min_offset(self, position):
-        min_offset = None
-        for i in range(len(self.route_points) / 2):
-            route_point = self.route_points[i]
-            offset = position - self.sumo_network.get_route_point_position(route_point)
-            offset = offset.length() 
-            if min_offset == None or offset < min_offset:
-                min_offset = offset
-        return min_offset
+        offsets = self.get_offsets(position)
+        if len(offsets) == 0:
+            return None
+        return offsets.min()
 
     def cut(self, position):
-        cut_index = 0
-        min_offset = None
-        min_offset_index = None
-        for i in range(len(self.route_points) / 2):
-            route_point = self.route_points[i]
-            offset = position - self.sumo_network.get_route_point_position(route_point)
-            offset = offset.length() 
-            if min_offset == None or offset < min_offset:
-                min_offset = offset
-                min_offset_index = i
-            if offset <= 1.0:
-                cut_index = i + 1
+        offsets = self.get_offsets(position)
+        if len(offsets) == 0:
+            return
 
+        min_offset_index = int(np.argmin(offsets))
         # Invalid path because too far away.
-        if min_offset > 1.0:
-            self.route_points = self.route_points[min_offset_index:]
+        if offsets[min_offset_index] > 1.0:
+            cut_index = min_offset_index
         else:
-            self.route_points = self.route_points[cut_index:]
+            cut_index = np.flatnonzero(offsets <= 1.0)[-1] + 1
+
+        for _ in range(cut_index):
+            self.route_points.popleft()
+        self.positions = self.positions[cut_index:]
 
     def get_position(self, index=0):
-        return self.sumo_network.get_route_point_position(self.route_points[index])
+        position = self.positions[index]
+        return carla.Vector2D(float(position[0]), float(position[1]))
 
     def get_yaw(self, index=0):
-        pos = self.sumo_network.get_route_point_position(self.route_points[index])
-        next_pos = self.sumo_network.get_route_point_position(self.route_points[index + 1])
-        return np.rad2deg(math.atan2(next_pos.y - pos.y, next_pos.x - pos.x))
+        (pos, next_pos) = (self.positions[index], self.positions[index + 1])
+        return np.rad2deg(math.atan2(next_pos[1] - pos[1], next_pos[0] - pos[0]))
+
+    def get_yaws(self):
+        '''
+        Yaw (degrees) at every point except the last.
+        '''
+        d = self.positions[1:] - self.positions[:-1]
+        return np.rad2deg(np.arctan2(d[:, 1], d[:, 0]))
+
+
+class GammaNeighbourhood(object):
+    '''
+    RVOSimulator kept across ticks for the ego vehicle and its neighbours.
+
+    An actor keeps its GAMMA agent while it stays in the neighbourhood and only
+    its state is rewritten each tick. RVOSimulator cannot remove agents, so the
+    agent of an actor that leaves is parked far from the map, at rest, and reused
+    for the next actor of the same type tag that enters. The ego vehicle is agent 0.
+    '''
+
+    PARKING_ORIGIN = (1.0e6, 1.0e6)
+    PARKING_SPACING = 100.0
+
+    def __init__(self):
+        self.gamma = carla.RVOSimulator()
+        self.gamma.add_agent(carla.AgentParams.get_default('Car'), 0)
+        self.next_gamma_id = 1
+        self.agents = {}  # actor id -> (gamma id, type tag)
+        self.free_agents = {}  # type tag -> parked gamma ids
+        self.adds = 0
+        self.reuses = 0
+
+    def update(self, neighbours):
+        '''
+        neighbours is a list of (actor id, type tag, position, velocity, heading,
+        bounding box corners). Returns nothing; call set_ego and do_step next.
+        '''
+        # Park departures first, so arrivals in the same tick can take their agents.
+        present = set(neighbour[0] for neighbour in neighbours)
+        for actor_id in [a for a in self.agents if a not in present]:
+            self.park(*self.agents.pop(actor_id))
+
+        for (actor_id, type_tag, position, velocity, heading, bounding_box_corners) in neighbours:
+            agent = self.agents.get(actor_id)
+            if agent is None or agent[1] != type_tag:
+                if agent is not None:
+                    self.park(*agent)
+                agent = (self.acquire(type_tag), type_tag)
+                self.agents[actor_id] = agent
+            self.set_state(agent[0], position, velocity, heading, bounding_box_corners, velocity)
+
+    def set_ego(self, position, velocity, heading, bounding_box_corners, pref_velocity, path_forward,
+                right_lane_constrained, left_lane_constrained):
+        self.set_state(0, position, velocity, heading, bounding_box_corners, pref_velocity)
+        self.gamma.set_agent_path_forward(0, path_forward)
+        self.gamma.set_agent_lane_constraints(0, right_lane_constrained, left_lane_constrained)
+
+    def do_step(self):
+        self.gamma.do_step()
+        return self.gamma.get_agent_velocity(0)
+
+    def set_state(self, gamma_id, position, velocity, heading, bounding_box_corners, pref_velocity):
+        self.gamma.set_agent_position(gamma_id, position)
+        self.gamma.set_agent_velocity(gamma_id, velocity)
+        self.gamma.set_agent_heading(gamma_id, heading)
+        self.gamma.set_agent_bounding_box_corners(gamma_id, bounding_box_corners)
+        self.gamma.set_agent_pref_velocity(gamma_id, pref_velocity)
+
+    def acquire(self, type_tag):
+        free = self.free_agents.get(type_tag)
+        if free:
+            self.reuses += 1
+            return free.pop()
+        gamma_id = self.next_gamma_id
+        self.next_gamma_id += 1
+        self.gamma.add_agent(carla.AgentParams.get_default(type_tag), gamma_id)
+        self.adds += 1
+        return gamma_id
+
+    def park(self, gamma_id, type_tag):
+        # Each parked agent gets its own spot, out of reach of the others and of the map.
+        position = carla.Vector2D(self.PARKING_ORIGIN[0] + gamma_id * self.PARKING_SPACING, self.PARKING_ORIGIN[1])
+        zero = carla.Vector2D(0, 0)
+        corners = [position + carla.Vector2D(dx, dy) for (dx, dy) in [(0.5, 0.5), (-0.5, 0.5), (-0.5, -0.5), (0.5, -0.5)]]
+        self.set_state(gamma_id, position, zero, carla.Vector2D(1, 0), corners, zero)
+        self.free_agents.setdefault(type_tag, []).append(gamma_id)
+
+    def stats(self):
+        return {
+            'active': len(self.agents),
+            'parked': sum(len(free) for free in self.free_agents.values()),
+            'adds': self.adds,
+            'reuses': self.reuses
+        }
 
 
 
@@ -131,6 +271,15 @@ class EgoVehicle(Summit):
         self.gamma_cmd_accel = 0
         self.gamma_cmd_steer = 0
         self.gamma_cmd_speed = 0
+        self.gamma = GammaNeighbourhood()
+        self.lane_adjacency = self.create_lane_adjacency()
+        # Probe length as in update_gamma_control.
+        self.sidewalk_field = self.load_sidewalk_field(1.5 + 2.0 + 0.8)
+        if self.sidewalk_field is None:
+            # update_gamma_control falls back to Sidewalk.intersects.
+            self.load_map_structures('sidewalk')
+        self.odom_inverse = None
+        self.last_gamma_report = time.time()
         self.pp_cmd_steer = 0
         self.pomdp_cmd_accel = 0
         self.pomdp_cmd_steer = 0
@@ -141,6 +290,7 @@ class EgoVehicle(Summit):
         self.speed_control_last_error = 0.0
         self.agents_ready = False
         self.last_crowd_range_update = None
+        self.stage_timers = StageTimers('ego_vehicle')
 
         self.start_time = None
         self.last_decision = REMAIN
@@ -215,11 +365,13 @@ class EgoVehicle(Summit):
             #    self.actor.set_collision_enabled(True)
 
         self.world.wait_for_tick(1.0)  # Wait for collision to be applied.
-        actor_physics_control = self.actor.get_physics_control()
-        self.steer_angle_range = \
-            (actor_physics_control.wheels[0].max_steer_angle + actor_physics_control.wheels[1].max_steer_angle) / 2
+        self.geometry = get_vehicle_geometry(self.actor)
+        self.steer_angle_range = self.geometry.steer_angle_range
+        # Last control sent to the vehicle; the same state get_control() would return.
+        self.control = carla.VehicleControl()
         
         time.sleep(1)  # wait for the vehicle to drop
+        self.update_snapshot()
         self.update_crowd_range()
         self.publish_odom()
         self.publish_il_car_info()
@@ -228,14 +380,13 @@ class EgoVehicle(Summit):
         self.broadcaster = None
         self.publish_odom_transform()
         self.transformer = TransformListener()
-
-        rospy.Timer(rospy.Duration(0.02), self.publish_il_car_info)
+        self.report_map_load_times()
 
     def dispose(self):
         self.actor.destroy()
 
     def get_position(self):
-        location = self.actor.get_location()
+        location = self.snapshot.get_location(self.actor.id)
         if location.z < -0.3:
             print("Car dropped under ground")
             self.ego_dead_pub.publish(True)
@@ -247,12 +398,13 @@ class EgoVehicle(Summit):
         cur_pose.header.stamp = rospy.Time.now()
         cur_pose.header.frame_id = "/map"
 
-        cur_pose.pose.position.x = self.actor.get_location().x
-        cur_pose.pose.position.y = self.actor.get_location().y
-        cur_pose.pose.position.z = self.actor.get_location().z
+        location = self.snapshot.get_location(self.actor.id)
+        cur_pose.pose.position.x = location.x
+        cur_pose.pose.position.y = location.y
+        cur_pose.pose.position.z = location.z
 
         quat = tf.transformations.quaternion_from_euler(
-            float(0), float(0), float(np.deg2rad(self.actor.get_transform().rotation.yaw)))
+            float(0), float(0), float(np.deg2rad(self.snapshot.get_yaw(self.actor.id))))
         cur_pose.pose.orientation.x = quat[0]
         cur_pose.pose.orientation.y = quat[1]
         cur_pose.pose.orientation.z = quat[2]
@@ -267,13 +419,14 @@ class EgoVehicle(Summit):
         transformStamped.header.frame_id = "map"
         transformStamped.child_frame_id = 'odom'
 
-        transformStamped.transform.translation.x = self.actor.get_location().x
-        transformStamped.transform.translation.y = self.actor.get_location().y
-        transformStamped.transform.translation.z = self.actor.get_location().z
+        location = self.snapshot.get_location(self.actor.id)
+        transformStamped.transform.translation.x = location.x
+        transformStamped.transform.translation.y = location.y
+        transformStamped.transform.translation.z = location.z
 
         quat = tf.transformations.quaternion_from_euler(
             float(0), float(0), float(
-                np.deg2rad(self.actor.get_transform().rotation.yaw)))
+                np.deg2rad(self.snapshot.get_yaw(self.actor.id))))
         transformStamped.transform.rotation.x = quat[0]
         transformStamped.transform.rotation.y = quat[1]
         transformStamped.transform.rotation.z = quat[2]
@@ -281,44 +434,35 @@ class EgoVehicle(Summit):
 
         return transformStamped
 
-    def get_transform_wrt_odom_frame(self):
-        try:
-            (trans, rot) = self.transformer.lookupTransform("map", "odom", rospy.Time(0.2))
-        except:
-            return None
-
-        cur_pose = self.get_cur_ros_pose()
-
+    def set_odom_frame(self, trans, rot):
+        '''
+        Caches the inverse of the static map -> odom transform given as (trans, rot).
+        '''
         transform = tftrans.concatenate_matrices(
             tftrans.translation_matrix(trans), tftrans.quaternion_matrix(rot))
-        inversed_transform = tftrans.inverse_matrix(transform)
-
-        inv_translation = tftrans.translation_from_matrix(inversed_transform)
-        inv_quaternion = tftrans.quaternion_from_matrix(inversed_transform)
-
-        transformStamped = geometry_msgs.msg.TransformStamped()
-        transformStamped.transform.translation.x = inv_translation[0]
-        transformStamped.transform.translation.y = inv_translation[1]
-        transformStamped.transform.translation.z = inv_translation[2]
-        transformStamped.transform.rotation.x = inv_quaternion[0]
-        transformStamped.transform.rotation.y = inv_quaternion[1]
-        transformStamped.transform.rotation.z = inv_quaternion[2]
-        transformStamped.transform.rotation.w = inv_quaternion[3]
+        self.odom_inverse = tftrans.inverse_matrix(transform)
 
-        cur_transform_wrt_odom = tf2_geometry_msgs.do_transform_pose(
-            cur_pose, transformStamped)
-
-        translation = cur_transform_wrt_odom.pose.position
-
-        quaternion = (
-            cur_transform_wrt_odom.pose.orientation.x,
-            cur_transform_wrt_odom.pose.orientation.y,
-            cur_transform_wrt_odom.pose.orientation.z,
-            cur_transform_wrt_odom.pose.orientation.w)
-
-        _, _, yaw = tf.transformations.euler_from_quaternion(quaternion)
-
-        return translation, yaw
+    def get_transform_wrt_odom_frame(self):
+        # The odom frame is static; tf is only asked when it has not been captured yet.
+        if self.odom_inverse is None:
+            try:
+                (trans, rot) = self.transformer.lookupTransform("map", "odom", rospy.Time(0.2))
+            except:
+                return None
+            self.set_odom_frame(trans, rot)
+
+        inv = self.odom_inverse
+        location = self.snapshot.get_location(self.actor.id)
+        yaw = np.deg2rad(self.snapshot.get_yaw(self.actor.id))
+
+        # Both the odom frame and the pose only rotate about z, so yaws simply add up.
+        translation = Point(
+            inv[0, 0] * location.x + inv[0, 1] * location.y + inv[0, 2] * location.z + inv[0, 3],
+            inv[1, 0] * location.x + inv[1, 1] * location.y + inv[1, 2] * location.z + inv[1, 3],
+            inv[2, 0] * location.x + inv[2, 1] * location.y + inv[2, 2] * location.z + inv[2, 3])
+        yaw += math.atan2(inv[1, 0], inv[0, 0])
+
+        return translation, math.atan2(math.sin(yaw), math.cos(yaw))
    
     def det(self, vector1, vector2):
         return vector1.y * vector2.x - vector1.x * vector2.y
@@ -336,9 +480,11 @@ class EgoVehicle(Summit):
             return False
         return True
     
-    def dist_to_nearest_agt_in_region(self, position, forward_vec, sidewalk_vec, lookahead_x=30, lookahead_y=4,
-                                      ref_point=None, consider_ped=False):
-
+    def get_lookahead_region(self, position, forward_vec, sidewalk_vec, lookahead_x=30, lookahead_y=4,
+                             ref_point=None, consider_ped=False):
+        '''
+        Region for dist_to_nearest_agt_in_regions: (position, corners, lookahead_x, consider_ped).
+        '''
         if ref_point is None:
             ref_point = position
 
@@ -347,25 +493,34 @@ class EgoVehicle(Summit):
                           ref_point + (lookahead_y / 2.0) * sidewalk_vec + lookahead_x * forward_vec,
                           ref_point - (lookahead_y / 2.0) * sidewalk_vec + lookahead_x * forward_vec]
 
-        min_dist = lookahead_x
-        for crowd_actor in self.world.get_actors():
-            if crowd_actor.id == self.actor.id:
-                continue
-            if isinstance(crowd_actor, carla.Vehicle) or (isinstance(crowd_actor, carla.Walker) and consider_ped):
-                pos_agt = get_position(crowd_actor)
-                if self.in_polygon(pos_agt, region_corners):
-                    min_dist = min(min_dist, (pos_agt - position).length())
-
-        return min_dist
+        return (position, region_corners, lookahead_x, consider_ped)
+
+    def dist_to_nearest_agt_in_regions(self, regions):
+        '''
+        For each region, the distance from its position to the nearest vehicle (or
+        pedestrian, if consider_ped) inside it, capped at lookahead_x. All regions
+        are tested against the snapshot in a single vectorized query.
+        '''
+        snapshot = self.snapshot
+        (rows, inside) = snapshot.query_polygons([corners for (_, corners, _, _) in regions])
+        rows_vehicle = snapshot.is_vehicle[rows]
+        rows_walker = snapshot.is_walker[rows]
+        rows_other = snapshot.ids[rows] != self.actor.id
+        rows_position = snapshot.locations[rows, 0:2]
+
+        min_dists = []
+        for (i, (position, _, lookahead_x, consider_ped)) in enumerate(regions):
+            mask = inside[i] & rows_other & (rows_vehicle | (rows_walker & consider_ped))
+            d = rows_position[mask] - (position.x, position.y)
+            min_dists.append(min(lookahead_x, np.sqrt((d ** 2).sum(axis=1)).min()) if len(d) > 0 else lookahead_x)
+        return min_dists
 
     def update_gamma_lane_decision(self):
         if not self.actor:
             return
         
-        pos = self.actor.get_location()
-        pos2D = carla.Vector2D(pos.x, pos.y)
-        vel = self.actor.get_velocity()
-        yaw = np.deg2rad(self.actor.get_transform().rotation.yaw)
+        pos2D = self.snapshot.get_position(self.actor.id)
+        yaw = np.deg2rad(self.snapshot.get_yaw(self.actor.id))
 
         forward_vec = carla.Vector2D(math.cos(yaw), math.sin(yaw))
         sidewalk_vec = forward_vec.rotate(np.deg2rad(90))  # rotate clockwise by 90 degree
@@ -376,39 +531,28 @@ class EgoVehicle(Summit):
         right_ego_veh_pos = ego_veh_pos + 4.0 * sidewalk_vec
 
         cur_route_point = self.sumo_network.get_nearest_route_point(ego_veh_pos)
-        left_route_point = self.sumo_network.get_nearest_route_point(left_ego_veh_pos)
-        right_route_point = self.sumo_network.get_nearest_route_point(right_ego_veh_pos)
-
-        left_lane_exist = False
-        right_lane_exist = False
 
-        if left_route_point.edge == cur_route_point.edge and left_route_point.lane != cur_route_point.lane:
-            left_lane_exist = True
-        else:
-            left_lane_exist = False
-        if right_route_point.edge == cur_route_point.edge and right_route_point.lane != cur_route_point.lane:
-            right_lane_exist = True
-        else:
-            right_lane_exist = False
-
-        min_dist_to_front_veh = self.dist_to_nearest_agt_in_region(ego_veh_pos, forward_vec, sidewalk_vec,
-                                                                   lookahead_x=30, lookahead_y=4, ref_point=None)
-        min_dist_to_left_front_veh = -1.0
-        min_dist_to_right_front_veh = -1.0
+        left_lane_exist = self.lane_adjacency.get_left(cur_route_point.edge, cur_route_point.lane) is not None
+        right_lane_exist = self.lane_adjacency.get_right(cur_route_point.edge, cur_route_point.lane) is not None
 
+        regions = [self.get_lookahead_region(ego_veh_pos, forward_vec, sidewalk_vec,
+                                             lookahead_x=30, lookahead_y=4, ref_point=None)]
+        # if want to change lane, also need to consider vehicles behind
         if left_lane_exist:
-            # if want to change lane, also need to consider vehicles behind
-            min_dist_to_left_front_veh = self.dist_to_nearest_agt_in_region(left_ego_veh_pos, forward_vec, sidewalk_vec,
-                                                                            lookahead_x=35, lookahead_y=4,
-                                                                            ref_point=left_ego_veh_pos - 12.0 * forward_vec,
-                                                                            consider_ped=True)
+            regions.append(self.get_lookahead_region(left_ego_veh_pos, forward_vec, sidewalk_vec,
+                                                     lookahead_x=35, lookahead_y=4,
+                                                     ref_point=left_ego_veh_pos - 12.0 * forward_vec,
+                                                     consider_ped=True))
         if right_lane_exist:
-            # if want to change lane, also need to consider vehicles behind
-            min_dist_to_right_front_veh = self.dist_to_nearest_agt_in_region(right_ego_veh_pos, forward_vec,
-                                                                             sidewalk_vec, lookahead_x=35,
-                                                                             lookahead_y=4,
-                                                                             ref_point=right_ego_veh_pos - 12.0 * forward_vec,
-                                                                             consider_ped=True)
+            regions.append(self.get_lookahead_region(right_ego_veh_pos, forward_vec, sidewalk_vec,
+                                                     lookahead_x=35, lookahead_y=4,
+                                                     ref_point=right_ego_veh_pos - 12.0 * forward_vec,
+                                                     consider_ped=True))
+        min_dists = self.dist_to_nearest_agt_in_regions(regions)
+
+        min_dist_to_front_veh = min_dists.pop(0)
+        min_dist_to_left_front_veh = min_dists.pop(0) if left_lane_exist else -1.0
+        min_dist_to_right_front_veh = min_dists.pop(0) if right_lane_exist else -1.0
 
         lane_decision = None
     
@@ -432,62 +576,66 @@ class EgoVehicle(Summit):
         self.last_decision = lane_decision
 
     def update_gamma_control(self):
-        gamma = carla.RVOSimulator()
-
-        gamma_id = 0
-        for (i, actor) in enumerate(self.world.get_actors()):
-            if actor.id == self.actor.id:
+        snapshot = self.snapshot
+        ego_position = snapshot.get_position(self.actor.id)
+        ego_forward = snapshot.get_forward_direction(self.actor.id)
+
+        neighbours = []
+        for i in snapshot.query_radius(ego_position, 20):
+            actor_id = snapshot.ids[i]
+            if actor_id == self.actor.id:
                 continue
 
-            if (get_position(self.actor) - get_position(actor)).length() > 20:
-                continue
-
-            if isinstance(actor, carla.Vehicle):
-                if actor.attributes['number_of_wheels'] == 2:
-                    type_tag = 'Bicycle'
-                else:
-                    type_tag = 'Car'
-                bounding_box_corners = get_vehicle_bounding_box_corners(actor)
-            elif isinstance(actor, carla.Walker):
-                type_tag = 'People'
-                bounding_box_corners = get_pedestrian_bounding_box_corners(actor)
+            if snapshot.is_vehicle[i]:
+                bounding_box_corners = snapshot.get_vehicle_bounding_box_corners(actor_id)
+            elif snapshot.is_walker[i]:
+                bounding_box_corners = snapshot.get_pedestrian_bounding_box_corners(actor_id)
             else:
                 continue
 
-            gamma.add_agent(carla.AgentParams.get_default(type_tag), gamma_id)
-            gamma.set_agent_position(gamma_id, get_position(actor))
-            gamma.set_agent_velocity(gamma_id, get_velocity(actor))
-            gamma.set_agent_heading(gamma_id, get_forward_direction(actor))
-            gamma.set_agent_bounding_box_corners(gamma_id, bounding_box_corners)
-            gamma.set_agent_pref_velocity(gamma_id, get_velocity(actor))
-            gamma_id += 1
-           
-        ego_id = gamma_id
-        gamma.add_agent(carla.AgentParams.get_default('Car'), ego_id)
-        gamma.set_agent_position(ego_id, get_position(self.actor))
-        gamma.set_agent_velocity(ego_id, get_velocity(self.actor))
-        gamma.set_agent_heading(ego_id, get_forward_direction(self.actor))
-        gamma.set_agent_bounding_box_corners(ego_id, get_vehicle_bounding_box_corners(self.actor))
+            neighbours.append((
+                actor_id,
+                snapshot.get_type_tag(actor_id),
+                snapshot.get_position(actor_id),
+                snapshot.get_velocity(actor_id),
+                snapshot.get_forward_direction(actor_id),
+                bounding_box_corners))
+        self.gamma.update(neighbours)
+
         target_position = self.path.get_position(5)
-        pref_vel = self.gamma_max_speed * (target_position - get_position(self.actor)).make_unit_vector()
+        pref_vel = self.gamma_max_speed * (target_position - ego_position).make_unit_vector()
         path_forward = (self.path.get_position(1) - 
                             self.path.get_position(0)).make_unit_vector()
-        gamma.set_agent_pref_velocity(ego_id, pref_vel)
-        gamma.set_agent_path_forward(ego_id, path_forward)
 
-        left_line_end = get_position(self.actor) + (1.5 + 2.0 + 0.8) * ((get_forward_direction(self.actor).rotate(np.deg2rad(-90))).make_unit_vector())
-        right_line_end = get_position(self.actor) + (1.5 + 2.0 + 0.8) * ((get_forward_direction(self.actor).rotate(np.deg2rad(90))).make_unit_vector())
-        left_lane_constrained_by_sidewalk = self.sidewalk.intersects(carla.Segment2D(get_position(self.actor), left_line_end))
-        right_lane_constrained_by_sidewalk = self.sidewalk.intersects(carla.Segment2D(get_position(self.actor), right_line_end))
+        left_line_end = ego_position + (1.5 + 2.0 + 0.8) * ((ego_forward.rotate(np.deg2rad(-90))).make_unit_vector())
+        right_line_end = ego_position + (1.5 + 2.0 + 0.8) * ((ego_forward.rotate(np.deg2rad(90))).make_unit_vector())
+        if self.sidewalk_field is not None:
+            left_lane_constrained_by_sidewalk = self.sidewalk_field.segment_crosses(ego_position, left_line_end)
+            right_lane_constrained_by_sidewalk = self.sidewalk_field.segment_crosses(ego_position, right_line_end)
+        else:
+            left_lane_constrained_by_sidewalk = self.sidewalk.intersects(carla.Segment2D(ego_position, left_line_end))
+            right_lane_constrained_by_sidewalk = self.sidewalk.intersects(carla.Segment2D(ego_position, right_line_end))
 
         # Flip left-right -> right-left since GAMMA uses a different handed coordinate system.
-        gamma.set_agent_lane_constraints(ego_id, right_lane_constrained_by_sidewalk, left_lane_constrained_by_sidewalk)  
-
-        gamma.do_step()
-        target_vel = gamma.get_agent_velocity(ego_id)
+        self.gamma.set_ego(
+            ego_position, snapshot.get_velocity(self.actor.id), ego_forward,
+            snapshot.get_vehicle_bounding_box_corners(self.actor.id), pref_vel, path_forward,
+            right_lane_constrained_by_sidewalk, left_lane_constrained_by_sidewalk)
+
+        target_vel = self.gamma.do_step()
+
+        if time.time() - self.last_gamma_report > 10.0:
+            stats = self.gamma.stats()
+            print('[ego_vehicle.py] GAMMA agents: active={} parked={} adds={} reuses={}'.format(
+                stats['active'], stats['parked'], stats['adds'], stats['reuses']))
+            stats = self.sumo_network.stats()
+            print('[ego_vehicle.py] nearest route point cache: size={} hits={} misses={} hit_rate={:.3f}'.format(
+                stats['size'], stats['hits'], stats['misses'], stats['hit_rate']))
+            sys.stdout.flush()
+            self.last_gamma_report = time.time()
 
         if False:
-            cur_pos = self.actor.get_location() 
+            cur_pos = snapshot.get_location(self.actor.id)
             next_pos = carla.Location(cur_pos.x + target_vel.x, cur_pos.y + target_vel.y, 0.0)
             pref_next_pos = carla.Location(cur_pos.x + pref_vel.x, cur_pos.y + pref_vel.y, 0.0)
             self.world.debug.draw_line(cur_pos, next_pos, life_time=0.05,
@@ -498,14 +646,14 @@ class EgoVehicle(Summit):
         self.gamma_cmd_speed = target_vel.length()
         self.gamma_cmd_steer = np.clip(
                 np.clip(
-                    VEHICLE_STEER_KP * get_signed_angle_diff(target_vel, get_forward_direction(self.actor)), 
+                    VEHICLE_STEER_KP * get_signed_angle_diff(target_vel, ego_forward), 
                     -45.0, 45.0) / self.steer_angle_range,
                 -1.0, 1.0)
 
     def update_crowd_range(self):
         # Cap frequency so that GAMMA loop doesn't die.
         if self.last_crowd_range_update is None or time.time() - self.last_crowd_range_update > 1.0:
-            pos = self.actor.get_location()
+            pos = self.snapshot.get_location(self.actor.id)
             bounds_min = carla.Vector2D(pos.x - self.crowd_range, pos.y - self.crowd_range)
             bounds_max = carla.Vector2D(pos.x + self.crowd_range, pos.y + self.crowd_range)
             exclude_bounds_min = carla.Vector2D(pos.x - self.exclude_crowd_range, pos.y - self.exclude_crowd_range)
@@ -520,6 +668,10 @@ class EgoVehicle(Summit):
         static_transformStamped = self.get_cur_ros_transform()
         self.broadcaster.sendTransform(static_transformStamped)
 
+        t = static_transformStamped.transform
+        self.set_odom_frame((t.translation.x, t.translation.y, t.translation.z),
+                            (t.rotation.x, t.rotation.y, t.rotation.z, t.rotation.w))
+
     def publish_odom(self):
         # Check if result available.
         result = self.get_transform_wrt_odom_frame()
@@ -533,12 +685,12 @@ class EgoVehicle(Summit):
 
         (translation, yaw) = result
         pos = carla.Location(translation.x, translation.y, translation.z)
-        vel = self.actor.get_velocity()
+        vel = self.snapshot.get_velocity_3d(self.actor.id)
         v_2d = np.array([vel.x, vel.y, 0])
         forward = np.array([math.cos(yaw), math.sin(yaw), 0])
         speed = np.vdot(forward, v_2d)
         odom_quat = tf.transformations.quaternion_from_euler(0, 0, yaw)
-        w_yaw = self.actor.get_angular_velocity().z
+        w_yaw = self.snapshot.get_angular_velocity(self.actor.id).z
 
         self.odom_broadcaster.sendTransform(
             (pos.x, pos.y, pos.z),
@@ -552,8 +704,8 @@ class EgoVehicle(Summit):
         odom.header.stamp = current_time
         odom.header.frame_id = frame_id
         # get pos and yaw w.r.t. the map frame
-        pos = self.actor.get_location()
-        yaw = np.deg2rad(self.actor.get_transform().rotation.yaw)
+        pos = self.snapshot.get_location(self.actor.id)
+        yaw = np.deg2rad(self.snapshot.get_yaw(self.actor.id))
         odom_quat = tf.transformations.quaternion_from_euler(0, 0, yaw)
         odom.pose.pose = Pose(Point(pos.x, pos.y, 0), Quaternion(*odom_quat))
         odom.child_frame_id = child_frame_id
@@ -563,10 +715,15 @@ class EgoVehicle(Summit):
     def publish_il_car_info(self, step=None):
         car_info_msg = CarInfo()
 
-        pos = self.actor.get_location()
-        pos2D = carla.Vector2D(pos.x, pos.y)
-        vel = self.actor.get_velocity()
-        yaw = np.deg2rad(self.actor.get_transform().rotation.yaw)
+        # Only the ego's own state is needed, so read its entry of the frame snapshot rather than
+        # rebuilding the whole-world WorldSnapshot up to 50 times a second.
+        actor_snapshot = self.world.get_snapshot().find(self.actor.id)
+        if actor_snapshot is None:
+            return
+        transform = actor_snapshot.get_transform()
+        pos = transform.location
+        vel = actor_snapshot.get_velocity()
+        yaw = np.deg2rad(transform.rotation.yaw)
         v_2d = np.array([vel.x, vel.y, 0])
         forward = np.array([math.cos(yaw), math.sin(yaw), 0])
         speed = np.vdot(forward, v_2d)
@@ -578,33 +735,28 @@ class EgoVehicle(Summit):
         car_info_msg.car_pos.z = pos.z
         car_info_msg.car_yaw = yaw
         car_info_msg.car_speed = speed
-        car_info_msg.car_steer = self.actor.get_control().steer
+        car_info_msg.car_steer = self.control.steer
         car_info_msg.car_vel.x = vel.x
         car_info_msg.car_vel.y = vel.y
         car_info_msg.car_vel.z = vel.z
 
         car_info_msg.car_bbox = Polygon()
-        corners = get_bounding_box_corners(self.actor)
+        (half_x_len, half_y_len) = self.geometry.bbox_extent
+        corners = get_box_corners(pos.x, pos.y, transform.rotation.yaw, self.geometry.bbox_location,
+                                  half_x_len, half_x_len, half_y_len)
         for corner in corners:
             car_info_msg.car_bbox.points.append(Point32(
                 x=corner.x, y=corner.y, z=0.0))
 
         car_info_msg.initial = False
         if step is None:
-            wheels = self.actor.get_physics_control().wheels
-            # TODO I think that CARLA might have forgotten to divide by 100 here.
-            wheel_positions = [w.position / 100 for w in wheels]
-
-            front_axle_center = (wheel_positions[0] + wheel_positions[1]) / 2
-            rear_axle_center = (wheel_positions[2] + wheel_positions[3]) / 2
-
-            car_info_msg.front_axle_center.x = front_axle_center.x
-            car_info_msg.front_axle_center.y = front_axle_center.y
-            car_info_msg.front_axle_center.z = front_axle_center.z
-            car_info_msg.rear_axle_center.x = rear_axle_center.x
-            car_info_msg.rear_axle_center.y = rear_axle_center.y
-            car_info_msg.rear_axle_center.z = rear_axle_center.z
-            car_info_msg.max_steer_angle = wheels[0].max_steer_angle
+            car_info_msg.front_axle_center.x = self.geometry.front_axle_center.x
+            car_info_msg.front_axle_center.y = self.geometry.front_axle_center.y
+            car_info_msg.front_axle_center.z = self.geometry.front_axle_center.z
+            car_info_msg.rear_axle_center.x = self.geometry.rear_axle_center.x
+            car_info_msg.rear_axle_center.y = self.geometry.rear_axle_center.y
+            car_info_msg.rear_axle_center.z = self.geometry.rear_axle_center.z
+            car_info_msg.max_steer_angle = self.geometry.max_steer_angle
 
             car_info_msg.initial = True
         try:
@@ -619,16 +771,17 @@ class EgoVehicle(Summit):
         gui_path.header.frame_id = 'map'
         gui_path.header.stamp = current_time
 
-        values = [(carla.Vector2D(self.actor.get_location().x, self.actor.get_location().y),
-                   self.actor.get_transform().rotation.yaw)]
+        position = self.snapshot.get_position(self.actor.id)
+        values = [(position.x, position.y, self.snapshot.get_yaw(self.actor.id))]
         # Exclude last point because no yaw information.
-        values += [(self.path.get_position(i), self.path.get_yaw(i)) for i in range(len(self.path.route_points) - 1)]
-        for (position, yaw) in values:
+        values += list(zip(self.path.positions[:-1, 0].tolist(), self.path.positions[:-1, 1].tolist(),
+                           self.path.get_yaws().tolist()))
+        for (x, y, yaw) in values:
             pose = PoseStamped()
             pose.header.frame_id = 'map'
             pose.header.stamp = current_time
-            pose.pose.position.x = position.x
-            pose.pose.position.y = position.y
+            pose.pose.position.x = x
+            pose.pose.position.y = y
             pose.pose.position.z = 0
             quaternion = tf.transformations.quaternion_from_euler(0, 0, np.deg2rad(yaw))
             pose.pose.orientation.x = quaternion[0]
@@ -666,7 +819,7 @@ class EgoVehicle(Summit):
             last_loc = carla.Location(pos.x, pos.y, 0.1)
 
     def send_control_from_vel(self):
-        control = self.actor.get_control()
+        control = self.control
         if self.control_mode == 'gamma':
             cmd_speed = min(self.gamma_cmd_speed, self.gamma_max_speed)
             cmd_steer = self.gamma_cmd_steer
@@ -680,8 +833,7 @@ class EgoVehicle(Summit):
         ki = self.KI
         kd = self.KD
 
-        cur_speed = self.actor.get_velocity()
-        cur_speed = (cur_speed.x ** 2 + cur_speed.y ** 2) ** 0.5
+        cur_speed = self.snapshot.get_velocity(self.actor.id).length()
 
         if PID_TUNING_ON:
             self.hyperparam_service.record_vels(cmd_speed, cur_speed)
@@ -742,7 +894,7 @@ class EgoVehicle(Summit):
     def send_control_from_acc(self):
         # Calculate control and send to CARLA.
         # print("controlling vehicle with acc={} cur_vel={}".format(self.cmd_accel, self.speed))
-        control = self.actor.get_control()
+        control = self.control
 
         if self.control_mode == 'gamma':
             cmd_accel = self.gamma_cmd_accel
@@ -773,9 +925,8 @@ class EgoVehicle(Summit):
         if lane_decision == REMAIN:
             return
 
-        pos = self.actor.get_location()
-        ego_veh_pos = carla.Vector2D(pos.x, pos.y)
-        yaw = np.deg2rad(self.actor.get_transform().rotation.yaw)
+        ego_veh_pos = self.snapshot.get_position(self.actor.id)
+        yaw = np.deg2rad(self.snapshot.get_yaw(self.actor.id))
 
         forward_vec = carla.Vector2D(math.cos(yaw), math.sin(yaw))
         sidewalk_vec = forward_vec.rotate(np.deg2rad(90))  # rotate clockwise by 90 degree
@@ -795,18 +946,20 @@ class EgoVehicle(Summit):
             if self.rng.uniform(0.0, 1.0) <= lane_change_probability:
                 new_path_candidates = self.sumo_network.get_next_route_paths(new_route_point, self.path.min_points - 1,
                                                                         self.path.interval)
-                new_path = NetworkAgentPath(self.sumo_network, self.path.min_points, self.path.interval)
-                new_path.route_points = self.rng.choice(new_path_candidates)[0:self.path.min_points]
+                new_path = NetworkAgentPath(self.sumo_network, self.path.min_points, self.path.interval,
+                                            self.rng.choice(new_path_candidates)[0:self.path.min_points])
                 print('NEW PATH!')
                 sys.stdout.flush()
                 self.path = new_path
 
     def update(self):
-        # start =time.time()
-
         if not self.agents_ready:
             return
 
+        t = time.time()
+        self.update_snapshot()
+        t = self.stage_timers.lap('snapshot', t)
+
         if not self.bounds_occupancy.contains(self.get_position()):
             print("Termination: Vehile exits map boundary")
             self.ego_dead_pub.publish(True)
@@ -823,24 +976,27 @@ class EgoVehicle(Summit):
                 print("Termination: Path extention failed !!!")
                 self.ego_dead_pub.publish(True)
                 return
+        t = self.stage_timers.lap('path', t)
 
         self.update_gamma_lane_decision()
+        t = self.stage_timers.lap('lane_decision', t)
 
         if self.control_mode == 'gamma':
             self.update_gamma_control()
+            t = self.stage_timers.lap('gamma_step', t)
 
         if self.speed_control_mode == 'acc':
             self.send_control_from_acc()
         elif self.speed_control_mode == 'vel':
             self.send_control_from_vel()
+        t = self.stage_timers.lap('control', t)
 
         # self.draw_path(self.path)
         self.update_crowd_range()
         self.publish_odom()
         # self.publish_il_car_info()
         self.publish_plan()
-
-        # print('({}) update rate: {} Hz'.format(os.getpid(), 1 / max(time.time() - start, 0.001)))
+        self.stage_timers.lap('publish', t)
 
 
 
@@ -851,8 +1007,11 @@ if __name__ == '__main__':
 
     ego_vehicle = EgoVehicle()
 
-    rate = rospy.Rate(20)
-    while not rospy.is_shutdown():
-        ego_vehicle.update()
-        rate.sleep()
+    # Vehicle control comes first; ego_state publishing is skipped when it would delay control.
+    scheduler = TickScheduler('ego_vehicle.py', report_period=rospy.get_param('~scheduler_report_period', 10.0))
+    scheduler.add_task('update', lambda event: ego_vehicle.update(), 20, priority=2)
+    scheduler.add_task('publish_il_car_info', ego_vehicle.publish_il_car_info, 50, priority=1, skippable=True)
+    scheduler.add_task('diagnostics', lambda event: ego_vehicle.stage_timers.publish(scheduler),
+                       rospy.get_param('~diagnostics_rate', 1.0), skippable=True)
+    scheduler.run()
     ego_vehicle.dispose()
@@ -0,0 +1,202 @@
+'''
+Shared-memory table of crowd local intentions.
+
+The crowd service, which is not part of this repository, rewrites a
+fixed-layout, memory-mapped file once per crowd tick with IntentionTableWriter;
+crowd_processor (IntentionTableReader) maps the same file and reads the records
+straight into NumPy without any serialization. The table is only read when
+crowd_processor has ~use_intention_table set. Writes are guarded by a sequence
+counter that is odd while a write is in progress.
+
+The writer builds the file under a temporary name and renames it into place, so a
+table left mapped by a reader is never truncated under it; a restarted writer
+replaces the file rather than reusing it. The header names the writer (pid and
+start time) and the time of its last write, so readers can tell a live table
+from one left behind.
+
+Layout: a 48 byte header (magic, layout version, writer pid, writer start time,
+sequence, count, capacity, last write time) followed by capacity records of
+RECORD_DTYPE.
+'''
+
+import errno
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+import carla
+
+MAGIC = 0x494e5454  # 'INTT'
+LAYOUT_VERSION = 2
+HEADER = struct.Struct('<IIIdQIId4x')
+
+AGENT_TYPES = ['Car', 'Bicycle', 'People']
+AGENT_TYPE_INDEX = {t: i for (i, t) in enumerate(AGENT_TYPES)}
+
+RECORD_DTYPE = np.dtype([
+    ('id', '<i4'),
+    ('type', 'u1'),
+    ('orientation', 'u1'),
+    ('edge', 'S64'),
+    ('lane', '<i4'),
+    ('segment', '<i4'),
+    ('polygon_id', '<i4'),
+    ('segment_id', '<i4'),
+    ('offset', '<f8'),
+])
+
+
+def default_table_path(pyro_port):
+    return '/dev/shm/summit_crowd_intentions_{}'.format(pyro_port)
+
+
+class IntentionTableWriter(object):
+    def __init__(self, path, capacity=4096):
+        self.path = path
+        self.capacity = capacity
+        self.pid = os.getpid()
+        self.start_time = time.time()
+        size = HEADER.size + capacity * RECORD_DTYPE.itemsize
+        temp_path = '{}.{}.tmp'.format(path, self.pid)
+        with open(temp_path, 'wb') as f:
+            f.truncate(size)
+        self.file = open(temp_path, 'r+b')
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.records = np.frombuffer(self.mmap, dtype=RECORD_DTYPE, count=capacity, offset=HEADER.size)
+        self.sequence = 0
+        self.write_header(0)
+        os.rename(temp_path, path)
+
+    def write_header(self, count):
+        self.mmap[0:HEADER.size] = HEADER.pack(
+            MAGIC, LAYOUT_VERSION, self.pid, self.start_time, self.sequence, count, self.capacity, time.time())
+
+    def write(self, local_intentions):
+        if len(local_intentions) > self.capacity:
+            raise ValueError('{} intentions exceed table capacity {}'.format(len(local_intentions), self.capacity))
+
+        rows = np.zeros(len(local_intentions), dtype=RECORD_DTYPE)
+        for (row, intention) in zip(rows, local_intentions):
+            row['id'] = intention[0]
+            row['type'] = AGENT_TYPE_INDEX[intention[1]]
+            route_point = intention[2]
+            row['offset'] = route_point.offset
+            if intention[1] == 'People':
+                row['polygon_id'] = route_point.polygon_id
+                row['segment_id'] = route_point.segment_id
+                row['orientation'] = intention[3]
+            else:
+                edge = route_point.edge.encode('utf-8')
+                if len(edge) > RECORD_DTYPE['edge'].itemsize:
+                    raise ValueError('Edge id {} too long for intention table'.format(route_point.edge))
+                row['edge'] = edge
+                row['lane'] = route_point.lane
+                row['segment'] = route_point.segment
+
+        self.sequence += 1  # Odd: write in progress.
+        self.write_header(len(rows))
+        self.records[0:len(rows)] = rows
+        self.sequence += 1
+        self.write_header(len(rows))
+
+    def close(self):
+        self.records = None
+        self.mmap.close()
+        # Leave the file alone if another writer has replaced it since.
+        try:
+            if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                os.remove(self.path)
+        except OSError:
+            pass
+        self.file.close()
+
+
+class IntentionTableView(object):
+    '''
+    Read-only lookup from agent id to intention (without id) over a consistent copy
+    of the table. Intention tuples are only built for the ids actually looked up.
+    '''
+
+    def __init__(self, records):
+        self.records = records
+        self.rows = dict(zip(records['id'].tolist(), range(len(records))))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, agent_id):
+        return agent_id in self.rows
+
+    def __getitem__(self, agent_id):
+        record = self.records[self.rows[agent_id]]
+        agent_type = AGENT_TYPES[record['type']]
+        if agent_type == 'People':
+            route_point = carla.SidewalkRoutePoint()
+            route_point.polygon_id = int(record['polygon_id'])
+            route_point.segment_id = int(record['segment_id'])
+            route_point.offset = float(record['offset'])
+            return (agent_type, route_point, bool(record['orientation']))
+        route_point = carla.SumoNetworkRoutePoint()
+        route_point.edge = record['edge'].decode('utf-8') if bytes is not str else record['edge']
+        route_point.lane = int(record['lane'])
+        route_point.segment = int(record['segment'])
+        route_point.offset = float(record['offset'])
+        return (agent_type, route_point)
+
+
+class IntentionTableReader(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, layout_version, self.writer_pid, self.writer_start_time, _, _, capacity, _) = \
+            HEADER.unpack(self.mmap[0:HEADER.size])
+        if magic != MAGIC or layout_version != LAYOUT_VERSION:
+            self.close()
+            raise ValueError('{} is not an intention table of layout version {}'.format(path, LAYOUT_VERSION))
+        self.records = np.frombuffer(self.mmap, dtype=RECORD_DTYPE, count=capacity, offset=HEADER.size)
+        self.sequence = None
+
+    def is_replaced(self):
+        '''
+        Whether the path no longer refers to the mapped table (removed, or replaced by a new writer).
+        '''
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except OSError:
+            return True
+
+    def is_fresh(self, max_age):
+        '''
+        Whether the writer is still running and wrote the table within the last max_age seconds.
+        '''
+        write_time = HEADER.unpack(self.mmap[0:HEADER.size])[7]
+        if time.time() - write_time > max_age:
+            return False
+        try:
+            os.kill(self.writer_pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def read(self, max_retries=100):
+        '''
+        Returns an IntentionTableView, or None if no consistent copy could be read.
+        '''
+        for _ in range(max_retries):
+            (_, _, _, _, sequence, count, _, _) = HEADER.unpack(self.mmap[0:HEADER.size])
+            if sequence % 2 == 1:
+                continue
+            records = self.records[0:count].copy()
+            if HEADER.unpack(self.mmap[0:HEADER.size])[4] == sequence:
+                self.sequence = sequence
+                return IntentionTableView(records)
+        return None
+
+    def close(self):
+        self.records = None
+        self.mmap.close()
+        self.file.close()
@@ -0,0 +1,100 @@
+import math
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import carla
+
+
+class LaneAdjacency(object):
+    '''
+    Left and right neighbour lanes of every non-internal lane of a SUMO network,
+    keyed by (edge, lane).
+
+    Built the way the ego vehicle used to check for a neighbour lane on every
+    tick: from a point on the lane, probe offset metres to each side (left is
+    -90 degrees from the lane direction, as in EgoVehicle) and take the nearest
+    route point. If it lies on the same edge but another lane, that lane is the
+    neighbour. Each lane is probed once, at the middle of its longest segment.
+    '''
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __len__(self):
+        return len(self.left)
+
+    def get_left(self, edge, lane):
+        return self.left.get((edge, lane))
+
+    def get_right(self, edge, lane):
+        return self.right.get((edge, lane))
+
+    def to_arrays(self):
+        '''
+        Arrays of edge, lane, left and right lane (-1 for none), for the map artifact cache.
+        '''
+        keys = sorted(self.left)
+        return {
+            'edges': np.array([edge for (edge, _) in keys]),
+            'lanes': np.array([lane for (_, lane) in keys], dtype=np.int32),
+            'left': np.array([-1 if self.left[k] is None else self.left[k] for k in keys], dtype=np.int32),
+            'right': np.array([-1 if self.right[k] is None else self.right[k] for k in keys], dtype=np.int32)
+        }
+
+    @staticmethod
+    def from_arrays(arrays):
+        left = {}
+        right = {}
+        for (edge, lane, left_lane, right_lane) in zip(
+                arrays['edges'].tolist(), arrays['lanes'].tolist(), arrays['left'].tolist(), arrays['right'].tolist()):
+            left[(edge, lane)] = None if left_lane < 0 else left_lane
+            right[(edge, lane)] = None if right_lane < 0 else right_lane
+        return LaneAdjacency(left, right)
+
+    @staticmethod
+    def build(sumo_network, net_xml_path, offset=4.0):
+        left = {}
+        right = {}
+        for (edge, lane, segment, segment_length) in LaneAdjacency.read_lanes(net_xml_path):
+            route_point = carla.SumoNetworkRoutePoint()
+            route_point.edge = edge
+            route_point.lane = lane
+            route_point.segment = segment
+
+            route_point.offset = 0.0
+            start = sumo_network.get_route_point_position(route_point)
+            route_point.offset = segment_length
+            end = sumo_network.get_route_point_position(route_point)
+            if (end - start).length() < 1e-6:
+                continue
+            position = start + 0.5 * (end - start)
+            sidewalk_vec = (end - start).make_unit_vector().rotate(math.radians(90))
+
+            for (table, probe) in [(left, position - offset * sidewalk_vec), (right, position + offset * sidewalk_vec)]:
+                neighbour = sumo_network.get_nearest_route_point(probe)
+                if neighbour.edge == edge and neighbour.lane != lane:
+                    table[(edge, lane)] = neighbour.lane
+                else:
+                    table[(edge, lane)] = None
+
+        return LaneAdjacency(left, right)
+
+    @staticmethod
+    def read_lanes(net_xml_path):
+        '''
+        Yields (edge, lane index, segment, segment length) for the longest segment
+        of every lane of the non-internal edges of a .net.xml file.
+        '''
+        for (_, element) in ET.iterparse(net_xml_path):
+            if element.tag != 'edge':
+                continue
+            if element.get('function') != 'internal':
+                for lane in element.iter('lane'):
+                    shape = [tuple(float(v) for v in point.split(',')[0:2]) for point in lane.get('shape').split()]
+                    lengths = [math.hypot(b[0] - a[0], b[1] - a[1]) for (a, b) in zip(shape[:-1], shape[1:])]
+                    if len(lengths) == 0:
+                        continue
+                    segment = max(range(len(lengths)), key=lambda i: lengths[i])
+                    yield (element.get('id'), int(lane.get('index')), segment, lengths[segment])
+            element.clear()
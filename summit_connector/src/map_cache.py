@@ -0,0 +1,93 @@
+'''
+On-disk cache of artifacts derived from the map files in DATA_PATH, shared by
+all connector nodes and episodes.
+
+An artifact is a set of named NumPy arrays plus a small JSON-able dict. It is
+stored under <cache_dir>/<map>/<name>-<key>/, where key digests the cache
+format version, the size and mtime of the source files and the build
+parameters; any change gives a new key and so a rebuild. Arrays are saved as
+.npy files and memory-mapped on load. Artifact directories are written under
+a temporary name and renamed into place, so concurrent nodes either see a
+complete artifact or none.
+
+Only structures this package derives itself can be cached. SumoNetwork,
+OccupancyMap, Sidewalk and SegmentMap are native CARLA objects without
+serialization, so they are still built from the map files in every node.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+MAP_CACHE_VERSION = 1
+
+
+class MapArtifactCache(object):
+    def __init__(self, cache_dir, map_location):
+        self.directory = os.path.join(os.path.expanduser(cache_dir), map_location)
+        self.hits = 0
+        self.builds = 0
+
+    def get_key(self, name, sources, params):
+        header = {
+            'version': MAP_CACHE_VERSION,
+            'name': name,
+            'sources': dict((os.path.basename(path), [os.stat(path).st_size, os.stat(path).st_mtime])
+                            for path in sources),
+            'params': params
+        }
+        return hashlib.sha1(json.dumps(header, sort_keys=True).encode('utf-8')).hexdigest()[0:16]
+
+    def get(self, name, sources, params, build):
+        '''
+        (arrays, meta) of the artifact, loaded from the cache or built with
+        build() -> (arrays, meta) and cached. Returns None if build() does.
+        '''
+        path = os.path.join(self.directory, '{}-{}'.format(name, self.get_key(name, sources, params)))
+        if os.path.isdir(path):
+            self.hits += 1
+            return self.load(path)
+
+        artifact = build()
+        if artifact is None:
+            return None
+        self.builds += 1
+        self.save(path, *artifact)
+        return self.load(path)
+
+    def load(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = dict((key, np.load(os.path.join(path, '{}.npy'.format(key)), mmap_mode='r'))
+                      for key in meta.pop('arrays'))
+        return (arrays, meta)
+
+    def save(self, path, arrays, meta):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.isdir(temp_path):
+            shutil.rmtree(temp_path)
+        os.mkdir(temp_path)
+        for (key, array) in arrays.items():
+            np.save(os.path.join(temp_path, '{}.npy'.format(key)), array)
+        with open(os.path.join(temp_path, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, arrays=sorted(arrays)), f)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # Another node stored the same artifact first.
+            shutil.rmtree(temp_path)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'builds': self.builds
+        }
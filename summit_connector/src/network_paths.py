@@ -0,0 +1,393 @@
+import math
+import zlib
+from collections import namedtuple
+
+from cache import LRUCache
+
+# Expanded path tree of a network agent: the route point paths and their positions.
+RoutePathTree = namedtuple('RoutePathTree', 'paths positions')
+
+# 64-bit FNV-style rolling hash over branch points. Only ints and floats are mixed in,
+# so values are stable across processes (unlike hash() of strings under hash randomization).
+TOPOLOGICAL_HASH_INIT = 14695981039346656037
+_HASH_PRIME = 1099511628211
+_HASH_MASK = (1 << 64) - 1
+_edge_hashes = {}
+
+
+def hash_branch_point(topological_hash, route_point, num_branches):
+    edge_hash = _edge_hashes.get(route_point.edge)
+    if edge_hash is None:
+        edge_hash = zlib.crc32(route_point.edge.encode('utf-8')) & 0xffffffff
+        _edge_hashes[route_point.edge] = edge_hash
+    for value in (edge_hash, route_point.lane, route_point.segment, hash(route_point.offset), num_branches):
+        topological_hash = ((topological_hash ^ (value & _HASH_MASK)) * _HASH_PRIME) & _HASH_MASK
+    return topological_hash
+
+
+def expand_route_paths(sumo_network, initial_route_point, horizon, resolution):
+    paths = [[initial_route_point]]
+
+    for _ in range(horizon):
+        next_paths = []
+        for path in paths:
+            next_route_points = sumo_network.get_next_route_points(path[-1], resolution)
+            next_paths.extend(path + [route_point] for route_point in next_route_points)
+        paths = next_paths
+
+    return paths
+
+
+def compute_topological_hash(sumo_network, initial_route_point, horizon, resolution):
+    '''
+    Hash of the branch points met expanding every path from initial_route_point, in
+    the order the paths are expanded. Only the path ends are kept, not the paths.
+    '''
+    route_points = [initial_route_point]
+    topological_hash = TOPOLOGICAL_HASH_INIT
+
+    for _ in range(horizon):
+        next_route_points = []
+        for route_point in route_points:
+            branches = sumo_network.get_next_route_points(route_point, resolution)
+            next_route_points.extend(branches)
+            if len(branches) > 1:
+                topological_hash = hash_branch_point(topological_hash, route_point, len(branches))
+        route_points = next_route_points
+
+    return topological_hash
+
+
+class CachedSumoNetwork(object):
+    '''
+    SumoNetwork with memoized get_nearest_route_point, keyed by the cell_size grid
+    cell of the query position. A hit returns the route point found for the first
+    query in that cell, so it can be off by up to a cell diagonal; the returned
+    route point is shared and must not be modified. Everything else is delegated
+    to the wrapped network.
+    '''
+
+    def __init__(self, sumo_network, cell_size=0.1, capacity=4096):
+        self.sumo_network = sumo_network
+        self.cell_size = cell_size
+        self.nearest_route_points = LRUCache(capacity)
+
+    def __getattr__(self, name):
+        return getattr(self.sumo_network, name)
+
+    def get_nearest_route_point(self, position):
+        key = (int(math.floor(position.x / self.cell_size)), int(math.floor(position.y / self.cell_size)))
+        route_point = self.nearest_route_points.get(key)
+        if route_point is None:
+            route_point = self.sumo_network.get_nearest_route_point(position)
+            self.nearest_route_points.put(key, route_point)
+        return route_point
+
+    def stats(self):
+        return self.nearest_route_points.stats()
+
+
+class RoutePathCache(object):
+    '''
+    LRU caches of expanded path trees and of topological hashes, keyed by the
+    initial route point (edge, lane, segment, offset) together with the horizon
+    and resolution. Expansion starts from the exact route point, so hits come from
+    agents that have not moved, such as those stopped in queues.
+    '''
+
+    def __init__(self, sumo_network, capacity=4096):
+        self.sumo_network = sumo_network
+        self.cache = LRUCache(capacity)
+        self.topological_hashes = LRUCache(capacity)
+
+    def get(self, route_point, horizon, resolution):
+        key = (route_point.edge, route_point.lane, route_point.segment, route_point.offset, horizon, resolution)
+
+        tree = self.cache.get(key)
+        if tree is None:
+            paths = expand_route_paths(self.sumo_network, route_point, horizon, resolution)
+            positions = [[self.sumo_network.get_route_point_position(p) for p in path] for path in paths]
+            tree = RoutePathTree(paths, positions)
+            self.cache.put(key, tree)
+
+        return tree
+
+    def get_topological_hash(self, route_point, horizon, resolution):
+        key = (route_point.edge, route_point.lane, route_point.segment, route_point.offset, horizon, resolution)
+        topological_hash = self.topological_hashes.get(key)
+        if topological_hash is None:
+            topological_hash = compute_topological_hash(self.sumo_network, route_point, horizon, resolution)
+            self.topological_hashes.put(key, topological_hash)
+        return topological_hash
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RoutePathNode(object):
+    __slots__ = ('route_point', 'position', 'depth', 'parent', 'children', 'dead_end')
+
+    def __init__(self, route_point, position, depth, parent=None):
+        self.route_point = route_point
+        self.position = position
+        self.depth = depth
+        self.parent = parent
+        self.children = []
+        self.dead_end = False
+
+
+def _direction(from_position, to_position):
+    return math.atan2(to_position.y - from_position.y, to_position.x - from_position.x)
+
+
+class CandidateBeam(object):
+    '''
+    Deterministic bound on the number of path candidates of a network agent.
+
+    Candidates are ranked by lane continuity (ending in the lane index the agent
+    is in), then by heading continuity (turn between the first and last step),
+    with the leaf route point as tie break. Candidates ending within end_region of
+    a better ranked one are dropped as duplicates. prunes counts the trees that
+    had to be cut and pruned_candidates the candidates removed.
+    '''
+
+    def __init__(self, max_candidates=8, end_region=1.0):
+        self.max_candidates = max_candidates
+        self.end_region = end_region
+        self.prunes = 0
+        self.pruned_candidates = 0
+
+    def select(self, root, leaves):
+        ranked = []
+        for leaf in leaves:
+            first = leaf
+            while first.parent is not root:
+                first = first.parent
+            turn = abs(_direction(leaf.parent.position, leaf.position) - _direction(root.position, first.position))
+            turn = min(turn, 2 * math.pi - turn)
+            route_point = leaf.route_point
+            ranked.append(((route_point.lane != root.route_point.lane, round(turn, 6),
+                            route_point.edge, route_point.lane, route_point.segment, route_point.offset), leaf))
+        ranked.sort(key=lambda x: x[0])
+
+        kept = []
+        for (_, leaf) in ranked:
+            if len(kept) >= self.max_candidates:
+                break
+            if any((leaf.position.x - k.position.x) ** 2 + (leaf.position.y - k.position.y) ** 2 <
+                   self.end_region ** 2 for k in kept):
+                continue
+            kept.append(leaf)
+
+        self.prunes += 1
+        self.pruned_candidates += len(leaves) - len(kept)
+        return kept
+
+    def stats(self):
+        return {
+            'max_candidates': self.max_candidates,
+            'prunes': self.prunes,
+            'pruned_candidates': self.pruned_candidates
+        }
+
+
+class NetworkPathTree(object):
+    '''
+    Persistent path tree of a single network agent.
+
+    Between ticks the tree is advanced instead of re-expanded: the prefix the agent
+    has already passed is trimmed and only the missing tail is extended with
+    get_next_route_points. A full rebuild (through the RoutePathCache) happens only
+    when the agent's edge or lane changes, or when it moves backwards.
+
+    Tree points stay on the resolution grid fixed at the last rebuild; the first
+    point of every path is the agent's own route point.
+
+    With a CandidateBeam, the tree is cut back to the beam's candidates whenever
+    it holds more full-horizon paths than allowed; pruned branches are not
+    extended again until the next rebuild.
+    '''
+
+    def __init__(self, sumo_network, route_path_cache, horizon, resolution, beam=None):
+        self.sumo_network = sumo_network
+        self.route_path_cache = route_path_cache
+        self.horizon = horizon
+        self.resolution = resolution
+        self.beam = beam
+        self.root = None
+        self.leaves = []
+        self.origin_position = None
+
+    def update(self, route_point):
+        '''
+        Advances the tree to route_point. Returns True if the tree was rebuilt.
+        '''
+        self.origin_position = self.sumo_network.get_route_point_position(route_point)
+
+        if self.root is not None and \
+                route_point.edge == self.root.route_point.edge and \
+                route_point.lane == self.root.route_point.lane and \
+                self._advance(route_point):
+            if self._extend():
+                self._prune()
+            return False
+
+        self._rebuild(route_point)
+        return True
+
+    def get_positions(self):
+        '''
+        Positions of all full-horizon paths, each starting at the agent's route point.
+        '''
+        limit = self.root.depth + self.horizon
+        paths = []
+        stack = [(child, [self.origin_position]) for child in reversed(self.root.children)]
+        while stack:
+            (node, prefix) = stack.pop()
+            path = prefix + [node.position]
+            if node.depth >= limit:
+                paths.append(path)
+            else:
+                stack.extend((child, path) for child in reversed(node.children))
+        return paths
+
+    def get_tree(self):
+        '''
+        The paths of get_positions as a tree (positions, parents, leaves) in preorder.
+        Node 0 is the agent's route point with parent -1; each leaf ends one path, in
+        the order of get_positions. Branches shorter than the horizon are left out.
+        '''
+        limit = self.root.depth + self.horizon
+        nodes = [self.root]
+        parents = [-1]
+        stack = [(child, 0) for child in reversed(self.root.children)]
+        while stack:
+            (node, parent) = stack.pop()
+            index = len(nodes)
+            nodes.append(node)
+            parents.append(parent)
+            if node.depth < limit:
+                stack.extend((child, index) for child in reversed(node.children))
+
+        # Children follow their parents in preorder, so one backward pass marks every node on a full path.
+        keep = [False] * len(nodes)
+        for i in range(len(nodes) - 1, 0, -1):
+            if nodes[i].depth >= limit:
+                keep[i] = True
+            if keep[i]:
+                keep[parents[i]] = True
+        if not keep[0]:
+            return ([], [], [])
+
+        remap = {}
+        positions = []
+        tree_parents = []
+        leaves = []
+        for (i, node) in enumerate(nodes):
+            if not keep[i]:
+                continue
+            remap[i] = len(positions)
+            position = self.origin_position if i == 0 else node.position
+            positions.append((position.x, position.y))
+            tree_parents.append(remap[parents[i]] if i > 0 else -1)
+            if i > 0 and node.depth >= limit:
+                leaves.append(remap[i])
+        return (positions, tree_parents, leaves)
+
+    def _rebuild(self, route_point):
+        tree = self.route_path_cache.get(route_point, self.horizon, self.resolution)
+
+        self.root = None
+        self.leaves = []
+        nodes = {}
+        for (path, positions) in zip(tree.paths, tree.positions):
+            parent = None
+            for (depth, (path_point, position)) in enumerate(zip(path, positions)):
+                # Paths of the cached tree share the route point objects of their common prefix.
+                node = nodes.get(id(path_point))
+                if node is None:
+                    node = RoutePathNode(path_point, position, depth, parent)
+                    nodes[id(path_point)] = node
+                    if parent is None:
+                        self.root = node
+                    else:
+                        parent.children.append(node)
+                parent = node
+            self.leaves.append(parent)
+
+        if self.root is None:
+            # No full-horizon path exists; keep the start point so the next tick can advance from it.
+            self.root = RoutePathNode(route_point, self.origin_position, 0)
+            self.root.dead_end = True
+            self.leaves = [self.root]
+
+        self._prune()
+
+    def _advance(self, route_point):
+        key = (route_point.segment, route_point.offset)
+        if key < (self.root.route_point.segment, self.root.route_point.offset):
+            return False
+
+        root = self.root
+        while len(root.children) == 1:
+            child = root.children[0]
+            if child.route_point.edge != route_point.edge or child.route_point.lane != route_point.lane:
+                break
+            if (child.route_point.segment, child.route_point.offset) > key:
+                break
+            root = child
+        self.root = root
+        # Let the passed prefix be collected.
+        self.root.parent = None
+        return True
+
+    def _extend(self):
+        '''
+        Extends leaves up to the horizon. Returns True if new branches were created.
+        '''
+        limit = self.root.depth + self.horizon
+        branched = False
+        leaves = []
+        stack = list(self.leaves)
+        while stack:
+            node = stack.pop()
+            if node.dead_end or node.depth >= limit:
+                leaves.append(node)
+                continue
+            next_route_points = self.sumo_network.get_next_route_points(node.route_point, self.resolution)
+            if len(next_route_points) == 0:
+                node.dead_end = True
+                leaves.append(node)
+                continue
+            if len(next_route_points) > 1:
+                branched = True
+            for route_point in next_route_points:
+                child = RoutePathNode(
+                    route_point, self.sumo_network.get_route_point_position(route_point), node.depth + 1, node)
+                node.children.append(child)
+                stack.append(child)
+        self.leaves = leaves
+        return branched
+
+    def _prune(self):
+        if self.beam is None:
+            return
+        limit = self.root.depth + self.horizon
+        full = [leaf for leaf in self.leaves if leaf.depth >= limit and leaf is not self.root]
+        if len(full) <= self.beam.max_candidates:
+            return
+
+        kept = set(id(leaf) for leaf in self.beam.select(self.root, full))
+        dropped = set()
+        for leaf in full:
+            if id(leaf) in kept:
+                continue
+            dropped.add(id(leaf))
+            # Remove the leaf and every ancestor left without children.
+            node = leaf
+            while node is not self.root:
+                node.parent.children.remove(node)
+                if len(node.parent.children) > 0:
+                    break
+                node = node.parent
+        self.leaves = [leaf for leaf in self.leaves if id(leaf) not in dropped]
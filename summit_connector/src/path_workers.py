@@ -0,0 +1,280 @@
+'''
+Path candidate generation for crowd agents, off the crowd_processor main loop.
+
+PathGenerator turns local intentions into path candidates. PathWorkerPool runs one
+PathGenerator per worker process and shards agents by id, so the incremental path
+tree of an agent stays in the same process from one job to the next. Workers are
+forked from crowd_processor and inherit its SUMO network and sidewalk; they never
+touch ROS or the CARLA client.
+
+Intentions and results cross the process boundary as plain tuples, since route
+points and vectors from the CARLA API cannot be pickled.
+'''
+
+import math
+import multiprocessing
+import signal
+import sys
+import time
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import carla
+
+from network_paths import RoutePathCache, NetworkPathTree, CandidateBeam
+from sidewalk_chains import SidewalkChains
+
+
+def pack_intention(actor_id, local_intention, speed=0.0):
+    '''
+    Picklable (actor id, agent type, route point fields, orientation, speed) for a
+    local intention as held in the crowd_processor lookup (without the id).
+    '''
+    route_point = local_intention[1]
+    if local_intention[0] == 'People':
+        return (actor_id, local_intention[0],
+                (route_point.polygon_id, route_point.segment_id, route_point.offset), local_intention[2], speed)
+    return (actor_id, local_intention[0],
+            (route_point.edge, route_point.lane, route_point.segment, route_point.offset), None, speed)
+
+
+def expand_path_tree(path_tree):
+    '''
+    Path candidates (lists of (x, y)) of a (positions, parents, leaves) path tree.
+    '''
+    (positions, parents, leaves) = path_tree
+    paths = []
+    for leaf in leaves:
+        path = []
+        node = leaf
+        while node >= 0:
+            path.append(positions[node])
+            node = parents[node]
+        path.reverse()
+        paths.append(path)
+    return paths
+
+
+class PathHorizon(object):
+    '''
+    Number of path steps per agent. Always horizon unless adaptive; then an agent
+    gets enough steps to cover speed * time_horizon (and at least min_length),
+    rounded up to a multiple of bucket steps and capped at horizon.
+
+    An agent's steps shrink only once a full bucket is unused, so speed noise does
+    not keep changing (and rebuilding) its path tree.
+    '''
+
+    def __init__(self, horizon=20, resolution=1.0, adaptive=False, time_horizon=4.0, min_length=5.0, bucket=5):
+        self.horizon = horizon
+        self.resolution = resolution
+        self.adaptive = adaptive
+        self.time_horizon = time_horizon
+        self.min_length = min_length
+        self.bucket = bucket
+        self.agent_steps = {}
+
+    def get_steps(self, actor_id, speed):
+        if not self.adaptive:
+            return self.horizon
+        length = max(speed * self.time_horizon, self.min_length)
+        needed = min(int(math.ceil(length / self.resolution)), self.horizon)
+        steps = self.agent_steps.get(actor_id)
+        if steps is None or needed > steps or needed <= steps - self.bucket:
+            steps = min(int(math.ceil(float(needed) / self.bucket)) * self.bucket, self.horizon)
+        return steps
+
+    def retain(self, steps):
+        # Remembers the steps of the agents in the last job only.
+        self.agent_steps = steps
+
+
+class PathGenerator(object):
+    def __init__(self, sumo_network, sidewalk, route_path_cache_size=4096,
+                 sidewalk_chain_resolution=0.5, max_path_candidates=8, path_candidate_end_region=1.0,
+                 path_horizon=None, name='path_generator'):
+        self.sumo_network = sumo_network
+        self.path_horizon = path_horizon if path_horizon is not None else PathHorizon()
+        self.sidewalk = sidewalk
+        self.route_path_cache = RoutePathCache(sumo_network, capacity=route_path_cache_size)
+        self.sidewalk_chains = SidewalkChains(sidewalk, resolution=sidewalk_chain_resolution)
+        # Shared by all path trees of this generator, so its counters cover every agent.
+        self.beam = CandidateBeam(max_path_candidates, path_candidate_end_region) if max_path_candidates > 0 else None
+        self.network_path_trees = {}
+        self.name = name
+        self.last_cache_report = time.time()
+
+    def compute(self, intentions):
+        '''
+        Returns (actor id, topological hash, path tree, cross_dirs) for each packed
+        intention. A path tree is (positions, parents, leaves) as built by
+        NetworkPathTree.get_tree; positions are (x, y) and do not include the agent
+        position.
+        '''
+        results = []
+        resolution = self.path_horizon.resolution
+        # Path trees of agents not in this job are dropped.
+        network_path_trees = {}
+        agent_steps = {}
+        for (actor_id, agent_type, route_point_fields, orientation, speed) in intentions:
+            steps = self.path_horizon.get_steps(actor_id, speed)
+            agent_steps[actor_id] = steps
+            if agent_type in ['Car', 'Bicycle']:
+                route_point = carla.SumoNetworkRoutePoint()
+                (route_point.edge, route_point.lane, route_point.segment, route_point.offset) = route_point_fields
+                path_tree = self.network_path_trees.get(actor_id)
+                if path_tree is None or path_tree.horizon != steps:
+                    path_tree = NetworkPathTree(self.sumo_network, self.route_path_cache, steps, resolution, self.beam)
+                path_tree.update(route_point)
+                network_path_trees[actor_id] = path_tree
+                # Over all paths from the exact route point at the full horizon, whatever the
+                # tree's steps, grid or pruning, so intention resets do not depend on them.
+                topological_hash = self.route_path_cache.get_topological_hash(
+                    route_point, self.path_horizon.horizon, resolution)
+                results.append((actor_id, topological_hash, path_tree.get_tree(), []))
+            elif agent_type == 'People':
+                route_point = carla.SidewalkRoutePoint()
+                (route_point.polygon_id, route_point.segment_id, route_point.offset) = route_point_fields
+                positions = self.get_sidewalk_positions(route_point, orientation, steps, resolution)
+                # A single path is a chain: each point's parent is the one before it.
+                path_tree = (positions, list(range(-1, len(positions) - 1)), [len(positions) - 1])
+                results.append((actor_id, (route_point.polygon_id, orientation), path_tree, [orientation]))
+        self.network_path_trees = network_path_trees
+        self.path_horizon.retain(agent_steps)
+
+        if time.time() - self.last_cache_report > 10.0:
+            stats = self.route_path_cache.stats()
+            print('[{}] route path cache: size={} hit_rate={:.3f} evictions={}'.format(
+                self.name, stats['size'], stats['hit_rate'], stats['evictions']))
+            if self.beam is not None:
+                stats = self.beam.stats()
+                print('[{}] candidate beam: max_candidates={} prunes={} pruned_candidates={}'.format(
+                    self.name, stats['max_candidates'], stats['prunes'], stats['pruned_candidates']))
+            sys.stdout.flush()
+            self.last_cache_report = time.time()
+
+        return results
+
+    def get_sidewalk_positions(self, route_point, orientation, steps, resolution):
+        chain_path = self.sidewalk_chains.get_path(route_point, orientation, steps, resolution)
+        if chain_path is not None:
+            return [tuple(p) for p in chain_path.tolist()]
+
+        # Polygon not covered by a chain; walk the sidewalk directly.
+        path = [route_point]
+        for _ in range(steps):
+            if orientation:
+                path.append(self.sidewalk.get_next_route_point(path[-1], resolution))
+            else:
+                path.append(self.sidewalk.get_previous_route_point(path[-1], resolution))
+        positions = [self.sidewalk.get_route_point_position(p) for p in path]
+        return [(p.x, p.y) for p in positions]
+
+
+def _worker_main(index, jobs, results, generator):
+    # Shutdown is driven by the parent; don't die on the terminal's Ctrl-C first.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        (job_id, intentions) = job
+        start = time.time()
+        try:
+            job_results = generator.compute(intentions)
+        except Exception:
+            # The agents of the shard are still answered for, with no path tree, so crowd_processor
+            # keeps their previous paths instead of waiting for the shard forever.
+            traceback.print_exc()
+            print('[path_worker {}] path job {} failed; {} agents keep their previous paths'.format(
+                index, job_id, len(intentions)))
+            sys.stdout.flush()
+            job_results = [(intention[0], None, None, None) for intention in intentions]
+        results.put((job_id, index, job_results, time.time() - start))
+
+
+class PathWorkerPool(object):
+    '''
+    Runs at most one path job at a time. submit() hands a job to the workers and
+    poll() returns (context, results) once all of them have answered. With
+    num_workers = 0 jobs are computed in the calling process during submit().
+
+    After each job, last_compute_time holds the compute time of its slowest shard
+    and last_latency the time from submit() to the poll() that returned it.
+    '''
+
+    def __init__(self, num_workers, sumo_network, sidewalk, **generator_args):
+        self.num_workers = num_workers
+        self.next_job_id = 0
+        self.pending = None  # (job id, context, number of shards outstanding, results, submit time, compute time)
+        self.last_compute_time = None
+        self.last_latency = None
+        self.workers = []
+        self.job_queues = []
+        self.results = None
+        self.generator = None
+
+        if num_workers == 0:
+            self.generator = PathGenerator(sumo_network, sidewalk, name='crowd_processor.py', **generator_args)
+            return
+
+        self.results = multiprocessing.Queue()
+        for i in range(num_workers):
+            generator = PathGenerator(sumo_network, sidewalk, name='path_worker {}'.format(i), **generator_args)
+            job_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(
+                target=_worker_main, args=(i, job_queue, self.results, generator))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+            self.job_queues.append(job_queue)
+
+    def busy(self):
+        return self.pending is not None
+
+    def submit(self, intentions, context):
+        job_id = self.next_job_id
+        self.next_job_id += 1
+
+        start = time.time()
+        if self.generator is not None:
+            results = self.generator.compute(intentions)
+            self.pending = (job_id, context, 0, results, start, time.time() - start)
+            return
+
+        shards = [[] for _ in range(self.num_workers)]
+        for intention in intentions:
+            shards[intention[0] % self.num_workers].append(intention)
+        for (job_queue, shard) in zip(self.job_queues, shards):
+            job_queue.put((job_id, shard))
+        self.pending = (job_id, context, self.num_workers, [], start, 0.0)
+
+    def poll(self):
+        while self.pending is not None:
+            (job_id, context, outstanding, results, submit_time, compute_time) = self.pending
+            if outstanding == 0:
+                self.pending = None
+                self.last_compute_time = compute_time
+                self.last_latency = time.time() - submit_time
+                return (context, results)
+            try:
+                (result_job_id, _, shard_results, shard_compute_time) = self.results.get_nowait()
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('Path worker exited unexpectedly')
+                return None
+            if result_job_id == job_id:
+                results.extend(shard_results)
+                self.pending = (job_id, context, outstanding - 1, results, submit_time,
+                                max(compute_time, shard_compute_time))
+        return None
+
+    def close(self):
+        for job_queue in self.job_queues:
+            job_queue.put(None)
+        for worker in self.workers:
+            worker.join(1.0)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python2
 
 from util import *
+from scheduler import TickScheduler
 import carla
 
 import numpy as np
@@ -106,7 +107,6 @@ class Pursuit(object):
         self.car_steer = 0.0
         self.path = Path()
         self.car_info = None
-        self.tm = rospy.Timer(rospy.Duration(0.1), self.cb_pose_timer)  ##0.2 for golfcart; 0.05
         rospy.Subscriber("ego_state", CarInfo, self.cb_car_info, queue_size=1)
         self.cmd_steer_pub = rospy.Publisher("/purepursuit_cmd_steer", Float32, queue_size=1)
         self.length = 2.8
@@ -167,4 +167,7 @@ class Pursuit(object):
 if __name__ == '__main__':
     rospy.init_node('purepursuit')
     pursuit = Pursuit()
-    rospy.spin()
+
+    scheduler = TickScheduler('purepursuit_controller.py', report_period=rospy.get_param('~scheduler_report_period', 10.0))
+    scheduler.add_task('pursuit', pursuit.cb_pose_timer, 10, priority=1)  ##0.2 for golfcart; 0.05
+    scheduler.run()
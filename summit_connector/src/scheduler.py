@@ -0,0 +1,203 @@
+'''
+Cooperative scheduler for the periodic work of a connector node.
+
+All tasks run on the calling thread, so periodic work no longer competes for the
+GIL from rospy.Timer threads. Each task has a rate, a priority (higher runs
+first) and a deadline relative to its release (the period by default). Skippable
+tasks are skipped, or replaced by their degrade callback, when running them now
+would make a higher priority task start too late to meet its deadline, but never
+more than max_consecutive_skips releases in a row, so they keep a minimum rate.
+
+A run overruns when the task's own execution takes longer than its deadline;
+time spent waiting behind other tasks after the release is recorded as jitter.
+
+Times are wall-clock seconds (time.time()), like the rest of the connector.
+'''
+
+import bisect
+import sys
+import time
+from collections import namedtuple
+
+import rospy
+
+# Passed to task callbacks, in the spirit of rospy.TimerEvent.
+TickEvent = namedtuple('TickEvent', 'scheduled started last_duration degraded')
+
+
+class Histogram(object):
+    '''
+    Counts of durations (seconds) over fixed bins in milliseconds.
+    '''
+
+    EDGES_MS = [0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.EDGES_MS) + 1)
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect.bisect_left(self.EDGES_MS, ms)] += 1
+        self.total += 1
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        '''
+        Upper bin edge (ms) below which at least fraction p of the samples fall.
+        '''
+        if self.total == 0:
+            return 0.0
+        target = p * self.total
+        count = 0
+        for (i, c) in enumerate(self.counts):
+            count += c
+            if count >= target:
+                return min(self.EDGES_MS[i], self.max) if i < len(self.EDGES_MS) else self.max
+        return self.max
+
+
+class PeriodicTask(object):
+    def __init__(self, name, callback, rate, priority=0, deadline=None, skippable=False, degrade=None,
+                 max_consecutive_skips=2):
+        self.name = name
+        self.callback = callback
+        self.period = 1.0 / rate
+        self.priority = priority
+        self.deadline = deadline if deadline is not None else self.period
+        self.skippable = skippable
+        self.degrade = degrade
+        self.max_consecutive_skips = max_consecutive_skips  # None: no limit.
+
+        self.next_release = None
+        self.consecutive_skips = 0
+        self.exec_estimate = 0.0  # Moving average of execution time.
+        self.last_duration = None
+        self.runs = 0
+        self.skips = 0
+        self.degrades = 0
+        self.forced_runs = 0
+        self.overruns = 0
+        self.missed_releases = 0
+        self.exec_histogram = Histogram()
+        self.jitter_histogram = Histogram()
+
+    def latest_start(self):
+        return self.next_release + self.deadline - self.exec_estimate
+
+    def stats(self):
+        return {
+            'rate': 1.0 / self.period,
+            'priority': self.priority,
+            'runs': self.runs,
+            'skips': self.skips,
+            'degrades': self.degrades,
+            'forced_runs': self.forced_runs,
+            'overruns': self.overruns,
+            'missed_releases': self.missed_releases,
+            'exec_p50_ms': self.exec_histogram.percentile(0.5),
+            'exec_p99_ms': self.exec_histogram.percentile(0.99),
+            'exec_max_ms': self.exec_histogram.max,
+            'jitter_p50_ms': self.jitter_histogram.percentile(0.5),
+            'jitter_p99_ms': self.jitter_histogram.percentile(0.99)
+        }
+
+
+class TickScheduler(object):
+    def __init__(self, name, report_period=10.0):
+        self.name = name
+        self.tasks = []
+        self.report_period = report_period
+        self.last_report = None
+
+    def add_task(self, name, callback, rate, priority=0, deadline=None, skippable=False, degrade=None,
+                 max_consecutive_skips=2):
+        '''
+        Registers callback(event) to run at rate Hz. event is a TickEvent.
+        '''
+        task = PeriodicTask(name, callback, rate, priority, deadline, skippable, degrade, max_consecutive_skips)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        now = time.time()
+        for task in self.tasks:
+            task.next_release = now
+        self.last_report = now
+
+        while not rospy.is_shutdown():
+            self.step()
+            delay = min(task.next_release for task in self.tasks) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def step(self):
+        now = time.time()
+        due = [task for task in self.tasks if task.next_release <= now]
+        due.sort(key=lambda task: (-task.priority, task.next_release))
+
+        for task in due:
+            now = time.time()
+            if task.skippable and self.would_delay_higher_priority(task, now):
+                if task.max_consecutive_skips is not None and task.consecutive_skips >= task.max_consecutive_skips:
+                    task.forced_runs += 1
+                elif task.degrade is not None:
+                    task.degrades += 1
+                    task.consecutive_skips = 0
+                    self.execute(task, task.degrade, now, True)
+                    continue
+                else:
+                    task.skips += 1
+                    task.consecutive_skips += 1
+                    self.release_next(task, now)
+                    continue
+            task.runs += 1
+            task.consecutive_skips = 0
+            self.execute(task, task.callback, now, False)
+
+        if self.report_period is not None and time.time() - self.last_report > self.report_period:
+            self.report()
+            self.last_report = time.time()
+
+    def would_delay_higher_priority(self, task, now):
+        finish = now + task.exec_estimate
+        return any(other.priority > task.priority and finish > other.latest_start()
+                   for other in self.tasks)
+
+    def execute(self, task, callback, now, degraded):
+        release = task.next_release
+        task.jitter_histogram.add(now - release)
+        callback(TickEvent(release, now, task.last_duration, degraded))
+        end = time.time()
+
+        duration = end - now
+        task.exec_histogram.add(duration)
+        task.exec_estimate = duration if task.last_duration is None else \
+            0.8 * task.exec_estimate + 0.2 * duration
+        task.last_duration = duration
+        # Waiting behind other tasks is jitter; only the task's own execution can overrun.
+        if duration > task.deadline:
+            task.overruns += 1
+        self.release_next(task, end)
+
+    def release_next(self, task, now):
+        task.next_release += task.period
+        if task.next_release <= now:
+            # Fell behind: drop the releases that already passed instead of running them in a burst.
+            missed = int((now - task.next_release) / task.period) + 1
+            task.missed_releases += missed
+            task.next_release += missed * task.period
+
+    def stats(self):
+        return dict((task.name, task.stats()) for task in self.tasks)
+
+    def report(self):
+        for task in self.tasks:
+            stats = task.stats()
+            print('[{}] {}: runs={} skips={} degrades={} forced={} overruns={} missed={} '
+                  'exec p50/p99/max={:.1f}/{:.1f}/{:.1f} ms jitter p50/p99={:.1f}/{:.1f} ms'.format(
+                      self.name, task.name, stats['runs'], stats['skips'], stats['degrades'], stats['forced_runs'],
+                      stats['overruns'], stats['missed_releases'], stats['exec_p50_ms'], stats['exec_p99_ms'], stats['exec_max_ms'],
+                      stats['jitter_p50_ms'], stats['jitter_p99_ms']))
+        sys.stdout.flush()
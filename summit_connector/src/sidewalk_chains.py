@@ -0,0 +1,93 @@
+import numpy as np
+import carla
+
+
+class SidewalkChain(object):
+    '''
+    Closed sidewalk polygon sampled at a fixed arc-length resolution in the
+    get_next_route_point direction. segment_arcs maps a segment id to the
+    arc length at the start of that segment.
+    '''
+
+    def __init__(self, arcs, positions, perimeter, segment_arcs):
+        self.arcs = arcs
+        self.positions = positions
+        self.perimeter = perimeter
+        self.segment_arcs = segment_arcs
+
+    def get_arc(self, route_point):
+        segment_arc = self.segment_arcs.get(route_point.segment_id)
+        if segment_arc is None:
+            return None
+        return (segment_arc + route_point.offset) % self.perimeter
+
+    def interpolate(self, arcs):
+        return np.column_stack((
+            np.interp(arcs, self.arcs, self.positions[:, 0], period=self.perimeter),
+            np.interp(arcs, self.arcs, self.positions[:, 1], period=self.perimeter)))
+
+
+class SidewalkChains(object):
+    '''
+    Per-polygon sidewalk chains, built on first use of a polygon and kept for the
+    lifetime of the map. A pedestrian's path is then a slice of the chain and a
+    linear interpolation, independent of the path horizon.
+
+    Chains follow the polygon at the sampling resolution, so corners sharper than
+    that resolution are cut slightly.
+    '''
+
+    MAX_SAMPLES = 200000
+
+    def __init__(self, sidewalk, resolution=0.5):
+        self.sidewalk = sidewalk
+        self.resolution = resolution
+        self.chains = {}
+
+    def get_chain(self, polygon_id):
+        if polygon_id not in self.chains:
+            self.chains[polygon_id] = self.build_chain(polygon_id)
+        return self.chains[polygon_id]
+
+    def build_chain(self, polygon_id):
+        route_point = carla.SidewalkRoutePoint()
+        route_point.polygon_id = polygon_id
+        route_point.segment_id = 0
+        route_point.offset = 0.0
+
+        arcs = []
+        positions = []
+        segment_arcs = {}
+        arc = 0.0
+        while len(arcs) < self.MAX_SAMPLES:
+            position = self.sidewalk.get_route_point_position(route_point)
+            arcs.append(arc)
+            positions.append((position.x, position.y))
+            segment_arcs.setdefault(route_point.segment_id, arc - route_point.offset)
+
+            next_route_point = self.sidewalk.get_next_route_point(route_point, self.resolution)
+            arc += self.resolution
+            if (next_route_point.segment_id, next_route_point.offset) <= \
+                    (route_point.segment_id, route_point.offset):
+                # Wrapped around to the start of the polygon.
+                perimeter = arc - next_route_point.offset
+                if perimeter <= 0:
+                    return None
+                return SidewalkChain(np.array(arcs), np.array(positions), perimeter, segment_arcs)
+            route_point = next_route_point
+
+        return None
+
+    def get_path(self, route_point, forward, horizon, interval):
+        '''
+        Positions (horizon + 1, 2) starting at route_point and moving forward or
+        backward along the polygon, or None if the chain does not cover it.
+        '''
+        chain = self.get_chain(route_point.polygon_id)
+        if chain is None:
+            return None
+        arc = chain.get_arc(route_point)
+        if arc is None:
+            return None
+        steps = np.arange(horizon + 1) * interval
+        return chain.interpolate(arc + steps if forward else arc - steps)
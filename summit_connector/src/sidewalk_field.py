@@ -0,0 +1,179 @@
+'''
+Signed distance field of the sidewalk of a map, for O(1) tests against its
+pedestrian lines.
+
+The sidewalk tested by the connector is OccupancyMap.create_sidewalk(d) of the
+road network polygons, whose pedestrian lines lie at distance d outside them.
+So the field is computed from the polygons of <map>.network.wkt, as their
+distance less d: zero on the pedestrian lines, negative on the road side.
+<map>.sidewalk.wkt is not used, as its polygons are not what
+Sidewalk.intersects tests. The field is rasterized once and kept in the map
+artifact cache, from which later runs memory-map it. Distances are in metres
+and are bilinearly interpolated between grid points. Building needs scipy;
+without it, load_sidewalk_field returns None.
+'''
+
+import math
+import re
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+
+def read_wkt_rings(wkt_path):
+    '''
+    Rings (arrays of (x, y)) of the (MULTI)POLYGON in a WKT file; holes are rings too.
+    '''
+    with open(wkt_path, 'r') as f:
+        text = f.read()
+    return [np.array([[float(v) for v in point.split()[0:2]] for point in ring.split(',')])
+            for ring in re.findall(r'\(([^()]+)\)', text)]
+
+
+def rasterize_rings(rings, origin, resolution, shape):
+    '''
+    Even-odd fill of the rings, sampled at the grid points origin + resolution * (col, row).
+    '''
+    (height, width) = shape
+    toggles = np.zeros((height, width + 1), dtype=np.int32)
+    for ring in rings:
+        a = ring
+        b = np.roll(ring, -1, axis=0)
+        (row_a, row_b) = ((a[:, 1] - origin[1]) / resolution, (b[:, 1] - origin[1]) / resolution)
+        # Rows whose grid line y = row lies in [min, max) of each edge.
+        first = np.ceil(np.minimum(row_a, row_b)).astype(np.int64)
+        last = np.ceil(np.maximum(row_a, row_b)).astype(np.int64)
+        counts = np.maximum(last - first, 0)
+        edges = np.repeat(np.arange(len(a)), counts)
+        if len(edges) == 0:
+            continue
+        rows = first[edges] + (np.arange(len(edges)) - np.repeat(np.cumsum(counts) - counts, counts))
+        t = (rows - row_a[edges]) / (row_b[edges] - row_a[edges])
+        cols = (a[edges, 0] + t * (b[edges, 0] - a[edges, 0]) - origin[0]) / resolution
+        keep = (rows >= 0) & (rows < height)
+        np.add.at(toggles, (rows[keep], np.clip(np.ceil(cols[keep]).astype(np.int64), 0, width)), 1)
+    return np.cumsum(toggles, axis=1)[:, 0:width] % 2 == 1
+
+
+def get_edge_distances(rings, origin, resolution, shape, max_distance):
+    '''
+    Exact distances from the grid points to the nearest ring edge, for grid points
+    within max_distance of one; inf elsewhere. Each edge only visits the grid
+    points of its bounding box grown by max_distance.
+    '''
+    (height, width) = shape
+    distances = np.full(shape, np.inf)
+    for ring in rings:
+        for (a, b) in zip(ring, np.roll(ring, -1, axis=0)):
+            ab = b - a
+            length_squared = ab.dot(ab)
+            if length_squared == 0:
+                continue
+            (c0, r0) = np.maximum(np.floor((np.minimum(a, b) - max_distance - origin) / resolution), 0).astype(np.int64)
+            (c1, r1) = np.ceil((np.maximum(a, b) + max_distance - origin) / resolution).astype(np.int64) + 1
+            (c1, r1) = (min(c1, width), min(r1, height))
+            if c0 >= c1 or r0 >= r1:
+                continue
+            x = origin[0] + np.arange(c0, c1) * resolution - a[0]
+            y = origin[1] + np.arange(r0, r1)[:, np.newaxis] * resolution - a[1]
+            t = np.clip((x * ab[0] + y * ab[1]) / length_squared, 0.0, 1.0)
+            block = distances[r0:r1, c0:c1]
+            np.minimum(block, np.hypot(x - t * ab[0], y - t * ab[1]), out=block)
+    distances[distances > max_distance] = np.inf
+    return distances
+
+
+class SidewalkField(object):
+    def __init__(self, values, origin, resolution):
+        self.values = values  # (rows, cols), row i at y = origin[1] + i * resolution.
+        self.origin = origin
+        self.resolution = resolution
+
+    @staticmethod
+    def build(wkt_path, sidewalk_distance, resolution=0.5, padding=10.0, exact_distance=3.0):
+        '''
+        Field of the pedestrian lines at sidewalk_distance from the polygons in wkt_path.
+        Distances up to exact_distance from the polygon boundary are exact at the grid
+        points; farther ones come from the distance transform of the raster, to within
+        about half a grid cell.
+        '''
+        rings = read_wkt_rings(wkt_path)
+        points = np.concatenate(rings)
+        origin = points.min(axis=0) - padding
+        shape = tuple(int(v) for v in np.ceil((points.max(axis=0) + padding - origin) / resolution)[::-1] + 1)
+        inside = rasterize_rings(rings, origin, resolution, shape)
+        # Distances to the nearest grid point across the boundary, less the half cell to the boundary itself.
+        values = np.where(
+            inside, 0.5 - ndimage.distance_transform_edt(inside), ndimage.distance_transform_edt(~inside) - 0.5)
+        values *= resolution
+        edge_distances = get_edge_distances(rings, origin, resolution, shape, exact_distance)
+        near = np.isfinite(edge_distances)
+        values[near] = np.where(inside, -edge_distances, edge_distances)[near]
+        values -= sidewalk_distance
+        return SidewalkField(values.astype(np.float32), (float(origin[0]), float(origin[1])), resolution)
+
+    def get_distances(self, points):
+        '''
+        Signed distances at points (N, 2); points off the grid take the nearest border value.
+        '''
+        (height, width) = self.values.shape
+        p = (np.asarray(points, dtype=np.float64).reshape(-1, 2) - self.origin) / self.resolution
+        col = np.clip(p[:, 0], 0, width - 1.001)
+        row = np.clip(p[:, 1], 0, height - 1.001)
+        (c0, r0) = (col.astype(np.int64), row.astype(np.int64))
+        (fc, fr) = (col - c0, row - r0)
+        v = self.values
+        return ((v[r0, c0] * (1 - fc) + v[r0, c0 + 1] * fc) * (1 - fr) +
+                (v[r0 + 1, c0] * (1 - fc) + v[r0 + 1, c0 + 1] * fc) * fr)
+
+    def get_distance(self, position):
+        return float(self.get_distances([(position.x, position.y)])[0])
+
+    def segment_crosses(self, start, end):
+        '''
+        Whether the segment start-end (carla.Vector2D) crosses the pedestrian lines,
+        i.e. the distances sampled along it at the grid resolution change sign.
+        '''
+        n = max(int(math.ceil((end - start).length() / self.resolution)), 1) + 1
+        t = np.linspace(0.0, 1.0, n)
+        points = np.column_stack((start.x + t * (end.x - start.x), start.y + t * (end.y - start.y)))
+        distances = self.get_distances(points)
+        return bool(distances.min() <= 0.0 <= distances.max())
+
+    def sample_points(self, count, max_distance, rng):
+        '''
+        count grid points (N, 2) within max_distance of the pedestrian lines, drawn with rng (random.Random).
+        '''
+        (rows, cols) = np.nonzero(np.abs(self.values) <= max_distance)
+        picks = [rng.randrange(len(rows)) for _ in range(count)] if len(rows) > 0 else []
+        return np.column_stack((
+            self.origin[0] + cols[picks] * self.resolution, self.origin[1] + rows[picks] * self.resolution))
+
+
+def load_sidewalk_field(map_cache, wkt_path, sidewalk_distance, resolution=0.5, exact_distance=3.0,
+                        validate=None):
+    '''
+    SidewalkField of the pedestrian lines at sidewalk_distance from the polygons in wkt_path,
+    from the MapArtifactCache map_cache, built if not cached yet. A field just built is only
+    cached if validate(field), when given, is true. Returns None if it is not cached and
+    cannot be built (no scipy) or fails validation.
+    '''
+    def build():
+        if ndimage is None:
+            return None
+        field = SidewalkField.build(wkt_path, sidewalk_distance, resolution, exact_distance=exact_distance)
+        if validate is not None and not validate(field):
+            return None
+        return ({'values': field.values}, {'origin': list(field.origin), 'resolution': field.resolution})
+
+    artifact = map_cache.get(
+        'sidewalk_field', [wkt_path],
+        {'sidewalk_distance': sidewalk_distance, 'resolution': resolution, 'exact_distance': exact_distance}, build)
+    if artifact is None:
+        return None
+    (arrays, meta) = artifact
+    return SidewalkField(arrays['values'], tuple(meta['origin']), meta['resolution'])
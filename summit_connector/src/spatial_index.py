@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class GridIndex(object):
+    '''
+    Uniform grid over 2D points for radius, axis-aligned box and oriented
+    rectangle queries. Queries return indices into the points array, sorted
+    in ascending order.
+    '''
+
+    def __init__(self, points, cell_size=10.0):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self.cells = {}
+
+        if len(self.points) == 0:
+            return
+
+        cells = np.floor(self.points / self.cell_size).astype(np.int64)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        sorted_cells = cells[order]
+        boundaries = np.flatnonzero(np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)) + 1
+        for (start, end) in zip(np.concatenate(([0], boundaries)), np.concatenate((boundaries, [len(order)]))):
+            cell = sorted_cells[start]
+            self.cells[(cell[0], cell[1])] = order[start:end]
+
+    def __len__(self):
+        return len(self.points)
+
+    def candidates(self, min_x, min_y, max_x, max_y):
+        '''
+        Indices of points in the grid cells overlapping the box (a superset of the points in the box).
+        '''
+        if len(self.cells) == 0:
+            return np.zeros(0, dtype=np.int64)
+        (cx_min, cy_min) = np.floor(np.array([min_x, min_y]) / self.cell_size).astype(np.int64)
+        (cx_max, cy_max) = np.floor(np.array([max_x, max_y]) / self.cell_size).astype(np.int64)
+
+        found = []
+        if (cx_max - cx_min + 1) * (cy_max - cy_min + 1) > len(self.cells):
+            for ((cx, cy), indices) in self.cells.items():
+                if cx_min <= cx <= cx_max and cy_min <= cy <= cy_max:
+                    found.append(indices)
+        else:
+            for cx in range(cx_min, cx_max + 1):
+                for cy in range(cy_min, cy_max + 1):
+                    indices = self.cells.get((cx, cy))
+                    if indices is not None:
+                        found.append(indices)
+
+        if len(found) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate(found))
+
+    def query_box(self, min_x, min_y, max_x, max_y):
+        indices = self.candidates(min_x, min_y, max_x, max_y)
+        p = self.points[indices]
+        mask = (p[:, 0] >= min_x) & (p[:, 0] <= max_x) & (p[:, 1] >= min_y) & (p[:, 1] <= max_y)
+        return indices[mask]
+
+    def query_radius(self, x, y, radius):
+        indices = self.candidates(x - radius, y - radius, x + radius, y + radius)
+        d = self.points[indices] - (x, y)
+        return indices[(d ** 2).sum(axis=1) <= radius ** 2]
+
+    def query_polygon(self, corners):
+        '''
+        Points strictly inside the convex polygon, i.e. to the left of every edge
+        (same convention as EgoVehicle.in_polygon).
+        '''
+        corners = np.asarray(corners, dtype=np.float64).reshape(-1, 2)
+        if len(corners) < 3:
+            return np.zeros(0, dtype=np.int64)
+        (min_x, min_y) = corners.min(axis=0)
+        (max_x, max_y) = corners.max(axis=0)
+        indices = self.candidates(min_x, min_y, max_x, max_y)
+        return indices[points_in_polygon(self.points[indices], corners)]
+
+    def query_polygons(self, polygons):
+        '''
+        Points inside each of several convex polygons (R, M, 2) in one pass. Returns
+        (indices, mask): the candidate points of all polygons and an (R, len(indices))
+        mask of the candidates inside each polygon.
+        '''
+        if len(polygons) == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros((0, 0), dtype=bool))
+        polygons = np.asarray(polygons, dtype=np.float64).reshape(len(polygons), -1, 2)
+        if polygons.shape[1] < 3:
+            return (np.zeros(0, dtype=np.int64), np.zeros((len(polygons), 0), dtype=bool))
+        (min_x, min_y) = polygons.reshape(-1, 2).min(axis=0)
+        (max_x, max_y) = polygons.reshape(-1, 2).max(axis=0)
+        indices = self.candidates(min_x, min_y, max_x, max_y)
+        return (indices, points_in_polygons(self.points[indices], polygons))
+
+    def query_oriented_rect(self, center, forward, half_length, half_width):
+        forward = np.asarray(forward, dtype=np.float64)
+        forward = forward / np.linalg.norm(forward)
+        sideward = np.array([-forward[1], forward[0]])
+        center = np.asarray(center, dtype=np.float64)
+        # Same winding as the region corners in EgoVehicle.dist_to_nearest_agt_in_region.
+        corners = [center - half_length * forward + half_width * sideward,
+                   center + half_length * forward + half_width * sideward,
+                   center + half_length * forward - half_width * sideward,
+                   center - half_length * forward - half_width * sideward]
+        return self.query_polygon(corners)
+
+
+def points_in_polygon(points, corners):
+    '''
+    Vectorized EgoVehicle.in_polygon: mask of points (N, 2) lying to the left of
+    every edge of the polygon corners (M, 2).
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    corners = np.asarray(corners, dtype=np.float64).reshape(-1, 2)
+    mask = np.ones(len(points), dtype=bool)
+    for i in range(len(corners)):
+        a = corners[i]
+        b = corners[(i + 1) % len(corners)]
+        # det(a - c, b - a) > 0, with det(v1, v2) = v1.y * v2.x - v1.x * v2.y.
+        ac = a - points
+        mask &= ac[:, 1] * (b[0] - a[0]) - ac[:, 0] * (b[1] - a[1]) > 0
+    return mask
+
+
+def points_in_polygons(points, polygons):
+    '''
+    points_in_polygon for several polygons (R, M, 2) at once: an (R, N) mask.
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    polygons = np.asarray(polygons, dtype=np.float64)
+    a = polygons[:, :, np.newaxis, :]  # (R, M, 1, 2)
+    b = np.roll(polygons, -1, axis=1)[:, :, np.newaxis, :]
+    ac = a - points[np.newaxis, np.newaxis, :, :]  # (R, M, N, 2)
+    ab = b - a
+    return np.all(ac[..., 1] * ab[..., 0] - ac[..., 0] * ab[..., 1] > 0, axis=1)
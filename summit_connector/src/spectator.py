@@ -54,6 +54,7 @@ class Spectator(Summit):
 
         if record_video:
             self.timer = rospy.Timer(rospy.Duration(1.0 / fps), self.record_screen)
+        self.report_map_load_times()
 
     def record_screen(self, tick):
         if frame_array is None:
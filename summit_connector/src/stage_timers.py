@@ -0,0 +1,87 @@
+'''
+Always-on stage timing for connector nodes, published on /diagnostics.
+
+A tick is timed by chaining laps:
+
+    t = time.time()
+    ...
+    t = self.stage_timers.lap('snapshot', t)
+    ...
+    t = self.stage_timers.lap('publish', t)
+
+Each lap costs one time.time() call and a deque append. Percentiles over the last
+window samples of each stage are only computed when publishing (~diagnostics_rate, 1 Hz by default).
+'''
+
+import time
+from collections import deque
+
+import rospy
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+
+class StageTimers(object):
+    def __init__(self, name, window=500):
+        self.name = name
+        self.window = window
+        self.samples = {}
+        self.stages = []  # In first-recorded order, for a stable message layout.
+        self.publisher = None
+        self.last_overruns = {}
+
+    def lap(self, stage, start):
+        now = time.time()
+        self.record(stage, now - start)
+        return now
+
+    def record(self, stage, seconds):
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = deque(maxlen=self.window)
+            self.samples[stage] = samples
+            self.stages.append(stage)
+        samples.append(seconds)
+
+    def percentiles(self, stage, ps=(0.5, 0.9, 0.99)):
+        '''
+        Milliseconds at each fraction in ps, and the maximum, over the rolling window.
+        '''
+        samples = sorted(self.samples[stage])
+        n = len(samples)
+        return [samples[min(int(p * n), n - 1)] * 1000.0 for p in ps] + [samples[-1] * 1000.0]
+
+    def make_status(self, scheduler=None):
+        status = DiagnosticStatus()
+        status.name = '{}: stage timing'.format(self.name)
+        status.hardware_id = self.name
+        status.level = DiagnosticStatus.OK
+        status.message = 'OK'
+
+        for stage in self.stages:
+            (p50, p90, p99, max_ms) = self.percentiles(stage)
+            status.values.append(KeyValue(
+                '{} ms (p50/p90/p99/max)'.format(stage),
+                '{:.2f}/{:.2f}/{:.2f}/{:.2f}'.format(p50, p90, p99, max_ms)))
+
+        if scheduler is not None:
+            overrun_tasks = []
+            for (task_name, stats) in sorted(scheduler.stats().items()):
+                status.values.append(KeyValue(
+                    'task {} (runs/skips/overruns/missed)'.format(task_name),
+                    '{}/{}/{}/{}'.format(stats['runs'], stats['skips'], stats['overruns'], stats['missed_releases'])))
+                if stats['overruns'] > self.last_overruns.get(task_name, 0):
+                    overrun_tasks.append(task_name)
+                self.last_overruns[task_name] = stats['overruns']
+            if len(overrun_tasks) > 0:
+                status.level = DiagnosticStatus.WARN
+                status.message = 'Deadline overruns: {}'.format(', '.join(overrun_tasks))
+
+        return status
+
+    def publish(self, scheduler=None):
+        if self.publisher is None:
+            self.publisher = rospy.Publisher('/diagnostics', DiagnosticArray, queue_size=1)
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        msg.status.append(self.make_status(scheduler))
+        self.publisher.publish(msg)
@@ -15,8 +15,14 @@ except IndexError:
     sys.exit()
 
 import carla
+from world_snapshot import WorldSnapshot
+from network_paths import CachedSumoNetwork
+from lane_adjacency import LaneAdjacency
+from sidewalk_field import load_sidewalk_field
+from map_cache import MapArtifactCache
 
 from pathlib2 import Path
+import math
 import random
 import rospy
 import rospy
@@ -24,8 +30,80 @@ import time
 
 DATA_PATH = Path(summit_root)/'Data'   
 
+class MapStructure(object):
+    '''
+    Map structure attribute of Summit, built by load(summit) on first access and
+    then stored on the instance, so later reads are plain attribute lookups. The
+    structures in requires are loaded first, so the time logged covers this one only.
+
+    These are native CARLA objects with no serialization in the Python API, so
+    they cannot go in the map artifact cache and every node builds the ones it
+    uses from the map files. Nodes load them in __init__ (see load_map_structures),
+    so the cost stays at startup; what is saved is only the structures a node
+    never uses.
+    '''
+
+    def __init__(self, name, label, load, requires=()):
+        self.name = name
+        self.label = label
+        self.load = load
+        self.requires = requires
+
+    def __get__(self, summit, owner):
+        if summit is None:
+            return self
+        for name in self.requires:
+            getattr(summit, name)
+        start = time.time()
+        value = self.load(summit)
+        summit.map_load_times.append((self.label, time.time() - start))
+        summit.__dict__[self.name] = value
+        return value
+
+
+def load_sumo_network(summit):
+    return CachedSumoNetwork(
+        carla.SumoNetwork.load(str(DATA_PATH/'{}.net.xml'.format(summit.map_location))),
+        cell_size=rospy.get_param('~nearest_route_point_cell', 0.1),
+        capacity=rospy.get_param('~nearest_route_point_cache_size', 4096))
+
+
+def load_spawn_segments(segments, bounds_min, bounds_max, seed):
+    spawn_segments = segments.intersection(carla.OccupancyMap(bounds_min, bounds_max))
+    spawn_segments.seed_rand(seed)
+    return spawn_segments
+
+
 class Summit(object):
 
+    sumo_network = MapStructure('sumo_network', 'net.xml', load_sumo_network)
+    sumo_network_segments = MapStructure(
+        'sumo_network_segments', 'network segments', lambda summit: summit.sumo_network.create_segment_map(),
+        requires=('sumo_network',))
+    sumo_network_spawn_segments = MapStructure(
+        'sumo_network_spawn_segments', 'network spawn segments',
+        lambda summit: load_spawn_segments(
+            summit.sumo_network_segments, summit.bounds_min, summit.bounds_max, summit.sumo_network_spawn_seed),
+        requires=('sumo_network_segments',))
+    sumo_network_occupancy = MapStructure(
+        'sumo_network_occupancy', 'network.wkt',
+        lambda summit: carla.OccupancyMap.load(str(DATA_PATH/'{}.network.wkt'.format(summit.map_location))))
+    sidewalk = MapStructure(
+        'sidewalk', 'sidewalk',
+        lambda summit: summit.sumo_network_occupancy.create_sidewalk(summit.sidewalk_distance),
+        requires=('sumo_network_occupancy',))
+    sidewalk_segments = MapStructure(
+        'sidewalk_segments', 'sidewalk segments', lambda summit: summit.sidewalk.create_segment_map(),
+        requires=('sidewalk',))
+    sidewalk_spawn_segments = MapStructure(
+        'sidewalk_spawn_segments', 'sidewalk spawn segments',
+        lambda summit: load_spawn_segments(
+            summit.sidewalk_segments, summit.bounds_min, summit.bounds_max, summit.sidewalk_spawn_seed),
+        requires=('sidewalk_segments',))
+    sidewalk_occupancy = MapStructure(
+        'sidewalk_occupancy', 'sidewalk.wkt',
+        lambda summit: carla.OccupancyMap.load(str(DATA_PATH/'{}.sidewalk.wkt'.format(summit.map_location))))
+
     def __init__(self):
         address = rospy.get_param('address', '127.0.0.1')
         port = rospy.get_param('port', 2000)
@@ -33,37 +111,120 @@ class Summit(object):
         self.random_seed = rospy.get_param('random_seed', 1)
         self.rng = random.Random(rospy.get_param('random_seed', 0))
     
-        sys.stdout.flush()
-        with (DATA_PATH/'{}.sim_bounds'.format(self.map_location)).open('r') as f:
-            bounds_min = carla.Vector2D(*[float(v) for v in f.readline().split(',')])
-            bounds_max = carla.Vector2D(*[float(v) for v in f.readline().split(',')])
-            self.bounds_occupancy = carla.OccupancyMap(bounds_min, bounds_max)
-
-        sys.stdout.flush()
-        self.sumo_network = carla.SumoNetwork.load(str(DATA_PATH/'{}.net.xml'.format(self.map_location)))
-        self.sumo_network_segments = self.sumo_network.create_segment_map()
-        self.sumo_network_spawn_segments = self.sumo_network_segments.intersection(carla.OccupancyMap(bounds_min, bounds_max))
-        self.sumo_network_spawn_segments.seed_rand(self.rng.getrandbits(32))
-        self.sumo_network_occupancy = carla.OccupancyMap.load(str(DATA_PATH/'{}.network.wkt'.format(self.map_location)))
+        self.map_cache = MapArtifactCache(
+            rospy.get_param('~map_cache_dir', '~/.ros/summit_connector'), self.map_location)
 
-        sys.stdout.flush()
-        self.sidewalk = self.sumo_network_occupancy.create_sidewalk(1.5)
-        self.sidewalk_segments = self.sidewalk.create_segment_map()
-        self.sidewalk_spawn_segments = self.sidewalk_segments.intersection(carla.OccupancyMap(bounds_min, bounds_max))
-        self.sidewalk_spawn_segments.seed_rand(self.rng.getrandbits(32))
-        self.sidewalk_occupancy = carla.OccupancyMap.load(str(DATA_PATH/'{}.sidewalk.wkt'.format(self.map_location)))
+        with (DATA_PATH/'{}.sim_bounds'.format(self.map_location)).open('r') as f:
+            self.bounds_min = carla.Vector2D(*[float(v) for v in f.readline().split(',')])
+            self.bounds_max = carla.Vector2D(*[float(v) for v in f.readline().split(',')])
+            self.bounds_occupancy = carla.OccupancyMap(self.bounds_min, self.bounds_max)
+        self.sidewalk_distance = 1.5  # Of the pedestrian lines from the road network polygons.
+        # Map structures are loaded on first use (see MapStructure), so each node only builds
+        # the ones it needs. Spawn segment seeds are drawn now to keep the draws from self.rng
+        # in the same order whichever structures a node loads.
+        self.sumo_network_spawn_seed = self.rng.getrandbits(32)
+        self.sidewalk_spawn_seed = self.rng.getrandbits(32)
+        self.map_load_times = []
 
-        sys.stdout.flush()
         self.client = carla.Client(address, port)
         self.client.set_timeout(10.0)
         self.world = self.client.get_world()
+        self.snapshot = None
 
         sys.stdout.flush()
 
+    def load_map_structures(self, *names):
+        '''
+        Loads the named map structures now, for those a node would otherwise first use while running.
+        '''
+        for name in names:
+            getattr(self, name)
+
+    def report_map_load_times(self):
+        '''
+        Logs the map structures this node has loaded so far, with their load times, and those it has not.
+        '''
+        loaded = [name for (name, _) in self.map_load_times]
+        skipped = [v.label for v in vars(Summit).values() if isinstance(v, MapStructure) and v.label not in loaded]
+        print('[{}] map {} loaded in {:.2f} s ({}); not loaded: {}'.format(
+            rospy.get_name(), self.map_location, sum(t for (_, t) in self.map_load_times),
+            ', '.join('{} {:.2f} s'.format(name, t) for (name, t) in self.map_load_times),
+            ', '.join(sorted(skipped)) or 'none'))
+        sys.stdout.flush()
+
+    def create_lane_adjacency(self):
+        start = time.time()
+        net_xml_path = str(DATA_PATH/'{}.net.xml'.format(self.map_location))
+        (arrays, _) = self.map_cache.get(
+            'lane_adjacency', [net_xml_path], {'offset': 4.0},
+            lambda: (LaneAdjacency.build(self.sumo_network.sumo_network, net_xml_path).to_arrays(), {}))
+        lane_adjacency = LaneAdjacency.from_arrays(arrays)
+        print('[{}] lane adjacency of {} lanes loaded in {:.2f} s'.format(
+            rospy.get_name(), len(lane_adjacency), time.time() - start))
+        sys.stdout.flush()
+        return lane_adjacency
+
+    def load_sidewalk_field(self, probe_length):
+        '''
+        Signed distance field of the pedestrian lines of self.sidewalk, for testing
+        segments of up to probe_length against them. None without scipy, in which
+        case callers fall back to self.sidewalk.intersects.
+
+        With ~sidewalk_field_validate, a field just built is checked against
+        self.sidewalk.intersects on sample probes first, and is neither cached nor
+        used if they disagree too often. Cached fields are not checked again.
+        '''
+        start = time.time()
+        validation = []
+
+        def validate(sidewalk_field):
+            # Probes in random directions from points near the pedestrian lines; a private RNG
+            # leaves spawning unaffected.
+            rng = random.Random(0)
+            hits = 0
+            matches = 0
+            points = sidewalk_field.sample_points(
+                rospy.get_param('~sidewalk_field_samples', 1000), probe_length, rng)
+            for (x, y) in points.tolist():
+                angle = rng.uniform(0.0, 2.0 * math.pi)
+                (a, b) = (carla.Vector2D(x, y),
+                          carla.Vector2D(x + probe_length * math.cos(angle), y + probe_length * math.sin(angle)))
+                hit = self.sidewalk.intersects(carla.Segment2D(a, b))
+                hits += hit
+                matches += hit == sidewalk_field.segment_crosses(a, b)
+            agreement = matches / float(max(len(points), 1))
+            min_agreement = rospy.get_param('~sidewalk_field_min_agreement', 0.98)
+            print('[{}] sidewalk distance field matches Sidewalk.intersects on {:.1%} of {} probes ({} crossing){}'.format(
+                rospy.get_name(), agreement, len(points), hits,
+                '' if agreement >= min_agreement else '; below {:.1%}, not used'.format(min_agreement)))
+            sys.stdout.flush()
+            validation.append(agreement >= min_agreement)
+            return validation[-1]
+
+        sidewalk_field = load_sidewalk_field(
+            self.map_cache, str(DATA_PATH/'{}.network.wkt'.format(self.map_location)), self.sidewalk_distance,
+            resolution=rospy.get_param('~sidewalk_field_resolution', 0.5),
+            validate=validate if rospy.get_param('~sidewalk_field_validate', False) else None)
+        if sidewalk_field is None:
+            if validation == []:
+                rospy.logwarn('[{}] sidewalk distance field unavailable (scipy not found); '
+                              'lane constraints fall back to Sidewalk.intersects'.format(rospy.get_name()))
+            return None
+
+        print('[{}] sidewalk distance field {}x{} loaded in {:.2f} s'.format(
+            rospy.get_name(), sidewalk_field.values.shape[1], sidewalk_field.values.shape[0], time.time() - start))
+        sys.stdout.flush()
+        return sidewalk_field
 
     def reload_world(self):
         self.client.reload_world()
         self.world = self.client.get_world()
+        self.snapshot = None
+
+    def update_snapshot(self):
+        # Captures actor states once per simulation frame; repeated calls within a frame are free.
+        self.snapshot = WorldSnapshot.capture(self.world, self.snapshot)
+        return self.snapshot
 
     def draw_point(self, position, color=carla.Color(255, 0, 0), life_time=-1.0):
         self.world.debug.draw_point(
@@ -0,0 +1,196 @@
+import math
+from collections import namedtuple
+
+import numpy as np
+import carla
+
+from spatial_index import GridIndex
+
+# Static per-actor information, fetched once when an actor first appears in a snapshot.
+# kind is 'vehicle', 'walker' or None; type_tag is the GAMMA agent tag of the actor.
+ActorInfo = namedtuple('ActorInfo', 'actor kind type_tag bbox_location bbox_extent')
+
+
+def get_box_corners(x, y, yaw, bbox_location, half_x_len_backward, half_x_len_forward, half_y_len):
+    '''
+    Corners of the box of an actor at (x, y) with yaw (degrees), bbox_location being
+    the (x, y) offset of its bounding box centre.
+    '''
+    loc = carla.Vector2D(bbox_location[0] + x, bbox_location[1] + y)
+    forward_vec = carla.Vector2D(math.cos(np.deg2rad(yaw)), math.sin(np.deg2rad(yaw)))
+    sideward_vec = forward_vec.rotate(np.deg2rad(90))
+    return [loc - half_x_len_backward * forward_vec + half_y_len * sideward_vec,
+            loc + half_x_len_forward * forward_vec + half_y_len * sideward_vec,
+            loc + half_x_len_forward * forward_vec - half_y_len * sideward_vec,
+            loc - half_x_len_backward * forward_vec - half_y_len * sideward_vec]
+
+
+def make_actor_info(actor):
+    if isinstance(actor, carla.Vehicle):
+        kind = 'vehicle'
+        type_tag = 'Bicycle' if actor.attributes['number_of_wheels'] == 2 else 'Car'
+    elif isinstance(actor, carla.Walker):
+        kind = 'walker'
+        type_tag = 'People'
+    else:
+        return ActorInfo(actor, None, None, None, None)
+
+    bbox = actor.bounding_box
+    return ActorInfo(actor, kind, type_tag,
+                     (bbox.location.x, bbox.location.y),
+                     (bbox.extent.x, bbox.extent.y, bbox.extent.z))
+
+
+class WorldSnapshot(object):
+    '''
+    State of all vehicles and walkers at one simulation frame, captured from
+    world.get_snapshot() into NumPy arrays. Rows are looked up by actor id through
+    index. Radius and region queries go through a uniform grid built lazily
+    once per snapshot.
+
+    Static actor information (type, bounding box) is fetched only for actors that
+    were not in the previous snapshot, so the number of client round trips per
+    capture does not grow with the number of agents.
+    '''
+
+    @staticmethod
+    def capture(world, previous=None):
+        snapshot = world.get_snapshot()
+        if previous is not None and previous.frame == snapshot.frame:
+            return previous
+        return WorldSnapshot(world, snapshot, previous)
+
+    def __init__(self, world, snapshot, previous=None):
+        self.frame = snapshot.frame
+        self.elapsed_seconds = snapshot.timestamp.elapsed_seconds
+
+        previous_infos = previous.actor_infos if previous is not None else {}
+        actor_snapshots = list(snapshot)
+        new_ids = [s.id for s in actor_snapshots if s.id not in previous_infos]
+        new_infos = {}
+        if len(new_ids) > 0:
+            for actor in world.get_actors(new_ids):
+                new_infos[actor.id] = make_actor_info(actor)
+
+        self.actor_infos = {}
+        rows = []
+        for actor_snapshot in actor_snapshots:
+            info = previous_infos.get(actor_snapshot.id) or new_infos.get(actor_snapshot.id)
+            if info is None:
+                continue
+            self.actor_infos[actor_snapshot.id] = info
+            if info.kind is not None:
+                rows.append((actor_snapshot, info))
+        self.num_actors = len(self.actor_infos)
+
+        n = len(rows)
+        self.ids = np.zeros(n, dtype=np.int64)
+        self.locations = np.zeros((n, 3))
+        self.yaws = np.zeros(n)  # Degrees, as in carla.Rotation.
+        self.velocities = np.zeros((n, 3))
+        self.angular_velocities = np.zeros((n, 3))
+        self.bbox_locations = np.zeros((n, 2))
+        self.bbox_extents = np.zeros((n, 3))
+        self.is_vehicle = np.zeros(n, dtype=bool)
+        self.is_walker = np.zeros(n, dtype=bool)
+        self.index = {}
+
+        for (i, (actor_snapshot, info)) in enumerate(rows):
+            transform = actor_snapshot.get_transform()
+            velocity = actor_snapshot.get_velocity()
+            angular_velocity = actor_snapshot.get_angular_velocity()
+            self.ids[i] = actor_snapshot.id
+            self.locations[i] = (transform.location.x, transform.location.y, transform.location.z)
+            self.yaws[i] = transform.rotation.yaw
+            self.velocities[i] = (velocity.x, velocity.y, velocity.z)
+            self.angular_velocities[i] = (angular_velocity.x, angular_velocity.y, angular_velocity.z)
+            self.bbox_locations[i] = info.bbox_location
+            self.bbox_extents[i] = info.bbox_extent
+            self.is_vehicle[i] = info.kind == 'vehicle'
+            self.is_walker[i] = info.kind == 'walker'
+            self.index[actor_snapshot.id] = i
+
+        self.grid_index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, actor_id):
+        return actor_id in self.index
+
+    def get_grid_index(self):
+        if self.grid_index is None:
+            self.grid_index = GridIndex(self.locations[:, 0:2])
+        return self.grid_index
+
+    def query_radius(self, position, radius):
+        '''
+        Rows of the actors within radius of position (a carla.Vector2D).
+        '''
+        return self.get_grid_index().query_radius(position.x, position.y, radius)
+
+    def query_box(self, bounds_min, bounds_max):
+        return self.get_grid_index().query_box(bounds_min.x, bounds_min.y, bounds_max.x, bounds_max.y)
+
+    def query_polygon(self, corners):
+        '''
+        Rows of the actors inside the convex polygon given by corners (carla.Vector2D).
+        '''
+        return self.get_grid_index().query_polygon([(c.x, c.y) for c in corners])
+
+    def query_polygons(self, polygons):
+        '''
+        Candidate rows and their (len(polygons), len(rows)) inside mask for several
+        convex polygons, each given by corners (carla.Vector2D).
+        '''
+        return self.get_grid_index().query_polygons([[(c.x, c.y) for c in corners] for corners in polygons])
+
+    def get_actor(self, actor_id):
+        return self.actor_infos[actor_id].actor
+
+    def get_type_tag(self, actor_id):
+        return self.actor_infos[actor_id].type_tag
+
+    def get_location(self, actor_id):
+        l = self.locations[self.index[actor_id]]
+        return carla.Location(l[0], l[1], l[2])
+
+    def get_position(self, actor_id):
+        l = self.locations[self.index[actor_id]]
+        return carla.Vector2D(l[0], l[1])
+
+    def get_yaw(self, actor_id):
+        return self.yaws[self.index[actor_id]]
+
+    def get_forward_direction(self, actor_id):
+        yaw = np.deg2rad(self.yaws[self.index[actor_id]])
+        return carla.Vector2D(math.cos(yaw), math.sin(yaw))
+
+    def get_velocity(self, actor_id):
+        v = self.velocities[self.index[actor_id]]
+        return carla.Vector2D(v[0], v[1])
+
+    def get_velocity_3d(self, actor_id):
+        v = self.velocities[self.index[actor_id]]
+        return carla.Vector3D(v[0], v[1], v[2])
+
+    def get_angular_velocity(self, actor_id):
+        w = self.angular_velocities[self.index[actor_id]]
+        return carla.Vector3D(w[0], w[1], w[2])
+
+    def get_bounding_box_corners(self, actor_id, expand=0.0):
+        extent = self.bbox_extents[self.index[actor_id]]
+        return self._get_corners(actor_id, extent[0] + expand, extent[0] + expand, extent[1] + expand)
+
+    def get_vehicle_bounding_box_corners(self, actor_id):
+        extent = self.bbox_extents[self.index[actor_id]]
+        return self._get_corners(actor_id, extent[0] + 0.1, extent[0] + 1.0, extent[1] + 0.3)
+
+    def get_pedestrian_bounding_box_corners(self, actor_id):
+        # Hardcoded values for pedestrians.
+        return self._get_corners(actor_id, 0.25, 0.25, 0.25)
+
+    def _get_corners(self, actor_id, half_x_len_backward, half_x_len_forward, half_y_len):
+        i = self.index[actor_id]
+        return get_box_corners(self.locations[i][0], self.locations[i][1], self.yaws[i], self.bbox_locations[i],
+                               half_x_len_backward, half_x_len_forward, half_y_len)
@@ -0,0 +1,82 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from cache import ExpiringStore, LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_put_replaces_without_evicting(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.put('a', 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 10)
+        self.assertEqual(cache.evictions, 0)
+
+    def test_counts_hits_and_misses(self):
+        cache = LRUCache(4)
+        self.assertEqual(cache.hit_rate(), 0.0)
+        cache.put('a', 1)
+        cache.get('a')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 1.0 / 3.0)
+
+    def test_clear(self):
+        cache = LRUCache(4)
+        cache.put('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+
+class ExpiringStoreTest(unittest.TestCase):
+    def test_expires_entries_not_written_for_max_idle_ticks(self):
+        store = ExpiringStore(max_idle_ticks=2, capacity=10)
+        store.put('a', 1)
+        store.put('b', 2)
+        store.tick()
+        store.put('b', 3)
+        store.tick()
+        self.assertEqual(store.get('a'), 1)
+        store.tick()
+        self.assertNotIn('a', store)
+        self.assertEqual(store.get('b'), 3)
+        self.assertEqual(store.stats()['expirations'], 1)
+
+    def test_reads_do_not_refresh(self):
+        store = ExpiringStore(max_idle_ticks=1, capacity=10)
+        store.put('a', 1)
+        store.tick()
+        store.get('a')
+        store.tick()
+        self.assertNotIn('a', store)
+
+    def test_capacity_evicts_least_recently_written(self):
+        store = ExpiringStore(max_idle_ticks=100, capacity=2)
+        store.put('a', 1)
+        store.put('b', 2)
+        store.put('a', 3)
+        store.put('c', 4)
+        self.assertNotIn('b', store)
+        self.assertEqual((store.get('a'), store.get('c')), (3, 4))
+        self.assertEqual(store.stats()['evictions'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
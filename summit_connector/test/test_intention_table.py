@@ -0,0 +1,105 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import intention_table
+    from intention_table import HEADER, IntentionTableReader, IntentionTableWriter
+except ImportError:
+    # The CARLA PythonAPI egg is not on the path.
+    intention_table = None
+
+
+class RoutePoint(object):
+    def __init__(self, **fields):
+        for (name, value) in fields.items():
+            setattr(self, name, value)
+
+
+INTENTIONS = [
+    (3, 'Car', RoutePoint(edge='-12#1', lane=1, segment=4, offset=2.5)),
+    (7, 'Bicycle', RoutePoint(edge='40', lane=0, segment=0, offset=0.25)),
+    (9, 'People', RoutePoint(polygon_id=5, segment_id=2, offset=1.75), True)
+]
+
+
+@unittest.skipIf(intention_table is None, 'carla is not importable')
+class IntentionTableTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'intentions')
+        self.writer = IntentionTableWriter(self.path, capacity=8)
+        self.reader = IntentionTableReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.writer.write(INTENTIONS)
+        view = self.reader.read()
+        self.assertEqual(len(view), 3)
+        self.assertIn(7, view)
+        self.assertNotIn(4, view)
+
+        (agent_type, route_point) = view[3]
+        self.assertEqual(agent_type, 'Car')
+        self.assertEqual((route_point.edge, route_point.lane, route_point.segment, route_point.offset),
+                         ('-12#1', 1, 4, 2.5))
+        (agent_type, route_point, orientation) = view[9]
+        self.assertEqual(agent_type, 'People')
+        self.assertEqual((route_point.polygon_id, route_point.segment_id, route_point.offset), (5, 2, 1.75))
+        self.assertTrue(orientation)
+
+    def test_view_is_a_copy(self):
+        self.writer.write(INTENTIONS)
+        view = self.reader.read()
+        self.writer.write(INTENTIONS[0:1])
+        self.assertEqual(len(view), 3)
+        self.assertEqual(len(self.reader.read()), 1)
+
+    def test_no_read_while_a_write_is_in_progress(self):
+        self.writer.write(INTENTIONS)
+        self.writer.sequence += 1
+        self.writer.write_header(3)
+        self.assertIsNone(self.reader.read(max_retries=3))
+        self.writer.sequence += 1
+        self.writer.write_header(3)
+        self.assertEqual(self.reader.read().records['id'].tolist(), [3, 7, 9])
+        self.assertEqual(self.reader.sequence, 4)
+
+    def test_freshness(self):
+        self.writer.write(INTENTIONS)
+        self.assertTrue(self.reader.is_fresh(10.0))
+        self.assertFalse(self.reader.is_fresh(-1.0))
+
+    def test_replaced_by_a_new_writer(self):
+        self.assertFalse(self.reader.is_replaced())
+        writer = IntentionTableWriter(self.path, capacity=8)
+        try:
+            self.assertTrue(self.reader.is_replaced())
+            # The replaced table stays readable by the reader that mapped it.
+            self.writer.write(INTENTIONS)
+            self.assertEqual(len(self.reader.read()), 3)
+        finally:
+            writer.close()
+
+    def test_capacity(self):
+        with self.assertRaises(ValueError):
+            self.writer.write(INTENTIONS * 3)
+
+    def test_rejects_other_layouts(self):
+        path = os.path.join(self.directory, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * (HEADER.size + 64))
+        with self.assertRaises(ValueError):
+            IntentionTableReader(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
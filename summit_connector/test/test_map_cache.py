@@ -0,0 +1,69 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from map_cache import MapArtifactCache
+
+
+class MapArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'map.net.xml')
+        with open(self.source, 'w') as f:
+            f.write('<net/>')
+        self.cache = MapArtifactCache(os.path.join(self.directory, 'cache'), 'map')
+        self.builds = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self):
+        self.builds += 1
+        return ({'values': np.arange(6, dtype=np.float32).reshape(2, 3)}, {'resolution': 0.5})
+
+    def get(self, params=None):
+        return self.cache.get('field', [self.source], params or {'resolution': 0.5}, self.build)
+
+    def test_builds_once_then_memory_maps(self):
+        (arrays, meta) = self.get()
+        (cached_arrays, cached_meta) = self.get()
+        self.assertEqual(self.builds, 1)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'builds': 1})
+        self.assertEqual(cached_meta, {'resolution': 0.5})
+        self.assertIsInstance(cached_arrays['values'], np.memmap)
+        self.assertEqual(cached_arrays['values'].tolist(), arrays['values'].tolist())
+        # Only the finished artifact is left, no temporary directory.
+        self.assertEqual(len(os.listdir(self.cache.directory)), 1)
+
+    def test_rebuilds_when_params_or_sources_change(self):
+        self.get()
+        self.get({'resolution': 0.25})
+        self.assertEqual(self.builds, 2)
+        with open(self.source, 'a') as f:
+            f.write('<edge/>')
+        self.get()
+        self.assertEqual(self.builds, 3)
+
+    def test_failed_build_is_not_cached(self):
+        self.assertIsNone(self.cache.get('field', [self.source], {}, lambda: None))
+        self.assertFalse(os.path.isdir(self.cache.directory))
+        self.get()
+        self.assertEqual(self.builds, 1)
+
+    def test_keeps_an_artifact_stored_first_by_another_node(self):
+        key = self.cache.get_key('field', [self.source], {'resolution': 0.5})
+        path = os.path.join(self.cache.directory, 'field-{}'.format(key))
+        self.cache.save(path, {'values': np.zeros(2)}, {'resolution': 0.5})
+        self.cache.save(path, {'values': np.ones(2)}, {'resolution': 0.5})
+        self.assertEqual(self.cache.load(path)[0]['values'].tolist(), [0.0, 0.0])
+        self.assertEqual(os.listdir(self.cache.directory), ['field-{}'.format(key)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+import math
+import os
+import sys
+import unittest
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from network_paths import CachedSumoNetwork, CandidateBeam, NetworkPathTree, RoutePathCache, RoutePathNode, TOPOLOGICAL_HASH_INIT, \
+    compute_topological_hash, expand_route_paths, hash_branch_point
+
+Position = namedtuple('Position', 'x y')
+
+EDGE_LENGTH = 3.0
+
+
+class RoutePoint(object):
+    def __init__(self, edge, lane, segment, offset):
+        self.edge = edge
+        self.lane = lane
+        self.segment = segment
+        self.offset = offset
+
+
+class StubNetwork(object):
+    '''
+    Tree of straight edges EDGE_LENGTH long, standing in for carla.SumoNetwork.
+    Edge 'e' ends in three branches 'e.0', 'e.1' and 'e.2' that turn right, go
+    straight and turn left; branch k is in lane k % 2. Counts its calls.
+    '''
+
+    def __init__(self):
+        self.next_calls = 0
+        self.nearest_calls = 0
+
+    def get_nearest_route_point(self, position):
+        self.nearest_calls += 1
+        return RoutePoint('e', 0, 0, min(max(position.x, 0.0), EDGE_LENGTH))
+
+    def get_next_route_points(self, route_point, distance):
+        self.next_calls += 1
+        offset = route_point.offset + distance
+        if offset <= EDGE_LENGTH:
+            return [RoutePoint(route_point.edge, route_point.lane, route_point.segment, offset)]
+        return [RoutePoint('{}.{}'.format(route_point.edge, k), k % 2, 0, offset - EDGE_LENGTH) for k in range(3)]
+
+    def get_route_point_position(self, route_point):
+        (x, y, heading) = (0.0, 0.0, 0.0)
+        for k in route_point.edge.split('.')[1:]:
+            x += EDGE_LENGTH * math.cos(heading)
+            y += EDGE_LENGTH * math.sin(heading)
+            heading += (int(k) - 1) * 0.5
+        return Position(x + route_point.offset * math.cos(heading), y + route_point.offset * math.sin(heading))
+
+
+def route_point_key(route_point):
+    return (route_point.edge, route_point.lane, route_point.segment, route_point.offset)
+
+
+class RoutePathCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.network = StubNetwork()
+        self.cache = RoutePathCache(self.network, capacity=4)
+
+    def test_expansion_branches_at_edge_ends(self):
+        paths = expand_route_paths(self.network, RoutePoint('e', 0, 0, 0.5), 6, 1.0)
+        self.assertEqual(len(paths), 9)
+        self.assertTrue(all(len(path) == 7 for path in paths))
+        self.assertEqual(sorted(path[-1].edge for path in paths)[0:3], ['e.0.0', 'e.0.1', 'e.0.2'])
+
+    def test_paths_start_at_the_exact_offset(self):
+        route_point = RoutePoint('e', 0, 0, 0.3)
+        tree = self.cache.get(route_point, 5, 1.0)
+        expected = expand_route_paths(StubNetwork(), route_point, 5, 1.0)
+        self.assertEqual([[route_point_key(p) for p in path] for path in tree.paths],
+                         [[route_point_key(p) for p in path] for path in expected])
+        self.assertEqual(tree.paths[0][0].offset, 0.3)
+        self.assertEqual(tree.positions[0][1], self.network.get_route_point_position(tree.paths[0][1]))
+
+    def test_cache_is_keyed_by_exact_route_point_and_horizon(self):
+        self.cache.get(RoutePoint('e', 0, 0, 0.3), 5, 1.0)
+        calls = self.network.next_calls
+        tree = self.cache.get(RoutePoint('e', 0, 0, 0.3), 5, 1.0)
+        self.assertEqual(self.network.next_calls, calls)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        self.assertIsNot(self.cache.get(RoutePoint('e', 0, 0, 0.35), 5, 1.0), tree)
+        self.assertIsNot(self.cache.get(RoutePoint('e', 0, 0, 0.3), 4, 1.0), tree)
+        self.assertEqual(self.cache.stats()['misses'], 3)
+
+
+def tree_paths(tree):
+    '''
+    Paths of a (positions, parents, leaves) tree, from node 0 to each leaf.
+    '''
+    (positions, parents, leaves) = tree
+    paths = []
+    for leaf in leaves:
+        path = []
+        node = leaf
+        while node != -1:
+            path.append(positions[node])
+            node = parents[node]
+        paths.append(path[::-1])
+    return paths
+
+
+class NetworkPathTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.network = StubNetwork()
+        self.tree = NetworkPathTree(self.network, RoutePathCache(self.network), 6, 1.0)
+
+    def assert_full_horizon(self, route_point):
+        expected = expand_route_paths(StubNetwork(), route_point, 6, 1.0)
+        ends = sorted(route_point_key(path[-1]) for path in expected)
+        self.assertEqual(sorted(route_point_key(leaf.route_point) for leaf in self.tree.leaves), ends)
+
+    def test_advance_moves_root_without_rebuild(self):
+        self.assertTrue(self.tree.update(RoutePoint('e', 0, 0, 0.5)))
+        self.assertFalse(self.tree.update(RoutePoint('e', 0, 0, 1.5)))
+        self.assertEqual(self.tree.root.route_point.offset, 1.5)
+        self.assertIsNone(self.tree.root.parent)
+        self.assert_full_horizon(RoutePoint('e', 0, 0, 1.5))
+
+    def test_extend_only_expands_the_tail(self):
+        self.tree.update(RoutePoint('e', 0, 0, 0.5))
+        calls = self.network.next_calls
+        self.tree.update(RoutePoint('e', 0, 0, 1.5))
+        # One step more for each of the 9 paths, and the tree was not re-expanded.
+        self.assertEqual(self.network.next_calls - calls, 9)
+
+    def test_advance_stays_on_the_rebuild_grid(self):
+        self.tree.update(RoutePoint('e', 0, 0, 0.5))
+        self.assertFalse(self.tree.update(RoutePoint('e', 0, 0, 1.7)))
+        self.assertEqual(self.tree.root.route_point.offset, 1.5)
+        # Node 0 is still the agent's own position.
+        self.assertEqual(self.tree.get_tree()[0][0], tuple(self.network.get_route_point_position(
+            RoutePoint('e', 0, 0, 1.7))))
+
+    def test_rebuilds_when_moving_backwards_or_changing_edge(self):
+        self.tree.update(RoutePoint('e', 0, 0, 1.5))
+        self.assertTrue(self.tree.update(RoutePoint('e', 0, 0, 1.0)))
+        self.assertTrue(self.tree.update(RoutePoint('e.1', 1, 0, 0.5)))
+        self.assert_full_horizon(RoutePoint('e.1', 1, 0, 0.5))
+
+    def test_tree_matches_positions(self):
+        self.tree.update(RoutePoint('e', 0, 0, 0.5))
+        self.tree.update(RoutePoint('e', 0, 0, 2.5))
+        paths = [[tuple(p) for p in path] for path in self.tree.get_positions()]
+        self.assertEqual(len(paths), 9)
+        self.assertEqual(tree_paths(self.tree.get_tree()), paths)
+
+
+def string_topological_hash(sumo_network, route_point, horizon, resolution):
+    '''
+    The topological hash as crowd_processor used to build it, as a string.
+    '''
+    paths = [[route_point]]
+    topological_hash = ''
+    for _ in range(horizon):
+        next_paths = []
+        for path in paths:
+            next_route_points = sumo_network.get_next_route_points(path[-1], resolution)
+            next_paths.extend(path + [p] for p in next_route_points)
+            if len(next_route_points) > 1:
+                p = path[-1]
+                topological_hash += '({},{},{},{}={})'.format(p.edge, p.lane, p.segment, p.offset, len(next_route_points))
+        paths = next_paths
+    return topological_hash
+
+
+class TopologicalHashTest(unittest.TestCase):
+    def setUp(self):
+        self.network = StubNetwork()
+
+    def test_changes_exactly_when_the_string_hash_does(self):
+        route_points = [RoutePoint('e', 0, 0, offset / 4.0) for offset in range(12)] + \
+                       [RoutePoint('e.1', 1, 0, 0.5), RoutePoint('e.2', 0, 0, 0.5)]
+        strings = [string_topological_hash(self.network, p, 8, 1.0) for p in route_points]
+        hashes = [compute_topological_hash(self.network, p, 8, 1.0) for p in route_points]
+        self.assertGreater(len(set(strings)), 2)
+        for i in range(len(route_points)):
+            for j in range(len(route_points)):
+                self.assertEqual(strings[i] == strings[j], hashes[i] == hashes[j])
+
+    def test_no_branch_point_gives_the_initial_value(self):
+        self.assertEqual(compute_topological_hash(self.network, RoutePoint('e', 0, 0, 0.0), 2, 1.0),
+                         TOPOLOGICAL_HASH_INIT)
+
+    def test_branch_point_hash_is_deterministic(self):
+        route_point = RoutePoint('e.1', 1, 0, 3.0)
+        value = hash_branch_point(TOPOLOGICAL_HASH_INIT, route_point, 3)
+        self.assertEqual(value, hash_branch_point(TOPOLOGICAL_HASH_INIT, RoutePoint('e.1', 1, 0, 3.0), 3))
+        self.assertTrue(0 <= value < 2 ** 64)
+        self.assertNotEqual(value, hash_branch_point(TOPOLOGICAL_HASH_INIT, route_point, 2))
+        self.assertNotEqual(value, hash_branch_point(TOPOLOGICAL_HASH_INIT, RoutePoint('e.2', 1, 0, 3.0), 3))
+        self.assertNotEqual(value, hash_branch_point(TOPOLOGICAL_HASH_INIT, RoutePoint('e.1', 0, 0, 3.0), 3))
+
+    def test_cache_memoizes_by_exact_route_point(self):
+        cache = RoutePathCache(self.network)
+        value = cache.get_topological_hash(RoutePoint('e', 0, 0, 0.3), 8, 1.0)
+        calls = self.network.next_calls
+        self.assertEqual(cache.get_topological_hash(RoutePoint('e', 0, 0, 0.3), 8, 1.0), value)
+        self.assertEqual(self.network.next_calls, calls)
+        self.assertEqual(value, compute_topological_hash(StubNetwork(), RoutePoint('e', 0, 0, 0.3), 8, 1.0))
+        cache.get_topological_hash(RoutePoint('e', 0, 0, 0.31), 8, 1.0)
+        self.assertGreater(self.network.next_calls, calls)
+
+
+class CandidateBeamTest(unittest.TestCase):
+    def make_leaves(self, root, ends):
+        leaves = []
+        for (i, (x, y)) in enumerate(ends):
+            node = RoutePathNode(RoutePoint('e', 0, 0, 1.0), Position(1.0, 0.0), 1, root)
+            root.children.append(node)
+            leaf = RoutePathNode(RoutePoint('e', i % 2, 0, 2.0 + i), Position(x, y), 2, node)
+            node.children.append(leaf)
+            leaves.append(leaf)
+        return leaves
+
+    def test_prefers_lane_then_heading(self):
+        root = RoutePathNode(RoutePoint('e', 0, 0, 0.0), Position(0.0, 0.0), 0)
+        # Lanes alternate 0, 1, 0, 1; the straight lane 1 candidate ranks after both lane 0 ones.
+        leaves = self.make_leaves(root, [(2.0, 1.0), (2.0, 0.0), (2.0, -0.2), (2.0, 3.0)])
+        kept = CandidateBeam(max_candidates=3, end_region=0.1).select(root, leaves)
+        self.assertEqual(kept, [leaves[2], leaves[0], leaves[1]])
+
+    def test_drops_candidates_ending_close_to_a_better_one(self):
+        root = RoutePathNode(RoutePoint('e', 0, 0, 0.0), Position(0.0, 0.0), 0)
+        leaves = self.make_leaves(root, [(2.0, 0.0), (2.0, 0.0), (2.0, 0.5), (2.0, 3.0)])
+        beam = CandidateBeam(max_candidates=8, end_region=1.0)
+        self.assertEqual(beam.select(root, leaves), [leaves[0], leaves[3]])
+        self.assertEqual(beam.stats()['pruned_candidates'], 2)
+
+    def test_tree_is_cut_to_the_beam(self):
+        network = StubNetwork()
+        tree = NetworkPathTree(network, RoutePathCache(network), 6, 1.0, CandidateBeam(4, 0.1))
+        tree.update(RoutePoint('e', 0, 0, 0.5))
+        self.assertEqual(len(tree.get_positions()), 4)
+        self.assertTrue(all(leaf.route_point.lane == 0 for leaf in tree.leaves))
+        # Pruned branches are not extended again while the tree advances.
+        tree.update(RoutePoint('e', 0, 0, 1.5))
+        self.assertEqual(len(tree.get_positions()), 4)
+        self.assertEqual(len(tree_paths(tree.get_tree())), 4)
+
+    def test_selection_is_deterministic(self):
+        trees = []
+        for _ in range(2):
+            network = StubNetwork()
+            tree = NetworkPathTree(network, RoutePathCache(network), 6, 1.0, CandidateBeam(max_candidates=3))
+            tree.update(RoutePoint('e', 0, 0, 0.5))
+            trees.append(tree.get_tree())
+        self.assertEqual(trees[0], trees[1])
+
+
+class CachedSumoNetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.network = StubNetwork()
+        self.cached = CachedSumoNetwork(self.network, cell_size=0.1, capacity=2)
+
+    def test_memoizes_per_grid_cell(self):
+        first = self.cached.get_nearest_route_point(Position(1.01, 0.02))
+        # Same cell: the route point of the first query is returned.
+        self.assertIs(self.cached.get_nearest_route_point(Position(1.09, 0.08)), first)
+        self.assertEqual(self.network.nearest_calls, 1)
+        self.assertEqual(self.cached.get_nearest_route_point(Position(1.11, 0.02)).offset, 1.11)
+        self.assertEqual(self.network.nearest_calls, 2)
+
+    def test_negative_coordinates_use_their_own_cells(self):
+        self.cached.get_nearest_route_point(Position(0.05, 0.05))
+        self.cached.get_nearest_route_point(Position(-0.05, 0.05))
+        self.cached.get_nearest_route_point(Position(0.05, -0.05))
+        self.assertEqual(self.network.nearest_calls, 3)
+
+    def test_bounded_and_delegating(self):
+        for x in [0.5, 1.5, 2.5]:
+            self.cached.get_nearest_route_point(Position(x, 0.0))
+        self.assertEqual(self.cached.stats()['evictions'], 1)
+        route_point = RoutePoint('e', 0, 0, 2.0)
+        self.assertEqual(self.cached.get_route_point_position(route_point), self.network.get_route_point_position(route_point))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+try:
+    import scheduler
+    from scheduler import Histogram, TickScheduler
+except ImportError:
+    # rospy is not on the path outside a ROS environment.
+    scheduler = None
+
+
+@unittest.skipIf(scheduler is None, 'rospy is not importable')
+class HistogramTest(unittest.TestCase):
+    def test_percentiles_are_bin_upper_edges(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+        for ms in [0.05, 0.15, 0.15, 3.0, 40.0]:
+            histogram.add(ms / 1000.0)
+        self.assertEqual(histogram.total, 5)
+        self.assertEqual(histogram.percentile(0.2), 0.1)
+        self.assertEqual(histogram.percentile(0.6), 0.2)
+        self.assertEqual(histogram.percentile(0.8), 5.0)
+        # The top bin reports the maximum rather than its edge.
+        self.assertAlmostEqual(histogram.percentile(1.0), 40.0)
+
+    def test_beyond_the_last_edge(self):
+        histogram = Histogram()
+        histogram.add(2.5)
+        self.assertAlmostEqual(histogram.percentile(0.99), 2500.0)
+
+
+@unittest.skipIf(scheduler is None, 'rospy is not importable')
+class TickSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = TickScheduler('test', report_period=None)
+        self.calls = []
+
+    def add_task(self, name, rate, **args):
+        task = self.scheduler.add_task(name, lambda event: self.calls.append((name, event.degraded)), rate, **args)
+        task.next_release = time.time()
+        return task
+
+    def release_all(self):
+        for task in self.scheduler.tasks:
+            task.next_release = time.time()
+
+    def test_runs_due_tasks_by_priority(self):
+        self.add_task('low', 10)
+        self.add_task('high', 10, priority=1)
+        self.scheduler.step()
+        self.assertEqual(self.calls, [('high', False), ('low', False)])
+
+    def test_skips_a_slow_task_at_most_max_consecutive_skips(self):
+        self.add_task('high', 10, priority=1)
+        low = self.add_task('low', 10, skippable=True, max_consecutive_skips=2)
+        low.exec_estimate = 1.0
+        for _ in range(3):
+            self.release_all()
+            self.scheduler.step()
+        self.assertEqual(self.calls.count(('low', False)), 1)
+        self.assertEqual((low.skips, low.forced_runs, low.runs), (2, 1, 1))
+        self.assertEqual(low.consecutive_skips, 0)
+
+    def test_degrade_replaces_the_skip(self):
+        self.add_task('high', 10, priority=1)
+        low = self.scheduler.add_task(
+            'low', lambda event: None, 10, skippable=True, degrade=lambda event: self.calls.append(('low', event.degraded)))
+        low.exec_estimate = 1.0
+        self.release_all()
+        self.scheduler.step()
+        self.assertEqual(self.calls, [('high', False), ('low', True)])
+        self.assertEqual((low.degrades, low.skips), (1, 0))
+
+    def test_only_execution_time_overruns(self):
+        slow = self.scheduler.add_task('slow', lambda event: time.sleep(0.02), 100, deadline=0.01)
+        fast = self.add_task('fast', 100)
+        slow.next_release = time.time() - 0.5
+        fast.next_release = time.time() - 0.5
+        self.scheduler.step()
+        self.assertEqual((slow.overruns, fast.overruns), (1, 0))
+        self.assertGreater(fast.jitter_histogram.max, 100.0)
+
+    def test_missed_releases_are_dropped(self):
+        task = self.add_task('task', 10)
+        task.next_release = time.time() - 0.55
+        self.scheduler.step()
+        self.assertEqual(task.missed_releases, 5)
+        self.assertGreater(task.next_release, time.time())
+
+
+if __name__ == '__main__':
+    unittest.main()
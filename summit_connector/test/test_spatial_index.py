@@ -0,0 +1,63 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from spatial_index import GridIndex, points_in_polygon
+
+# Clockwise, so the inside is to the left of every edge as EgoVehicle.in_polygon expects.
+SQUARE = [(10.0, 10.0), (10.0, 30.0), (30.0, 30.0), (30.0, 10.0)]
+
+
+class GridIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.points = np.random.RandomState(0).uniform(-50.0, 50.0, (500, 2))
+        self.index = GridIndex(self.points, cell_size=7.0)
+
+    def test_radius_matches_brute_force(self):
+        for (x, y, radius) in [(0.0, 0.0, 10.0), (-45.0, 30.0, 25.0), (3.5, -7.0, 0.5), (0.0, 0.0, 200.0)]:
+            expected = np.flatnonzero(((self.points - (x, y)) ** 2).sum(axis=1) <= radius ** 2)
+            self.assertEqual(self.index.query_radius(x, y, radius).tolist(), expected.tolist())
+
+    def test_box_matches_brute_force(self):
+        (min_x, min_y, max_x, max_y) = (-20.0, 5.0, 13.0, 40.0)
+        p = self.points
+        expected = np.flatnonzero((p[:, 0] >= min_x) & (p[:, 0] <= max_x) & (p[:, 1] >= min_y) & (p[:, 1] <= max_y))
+        self.assertEqual(self.index.query_box(min_x, min_y, max_x, max_y).tolist(), expected.tolist())
+
+    def test_polygon_is_the_inside_of_a_clockwise_polygon(self):
+        p = self.points
+        expected = np.flatnonzero((p[:, 0] > 10.0) & (p[:, 0] < 30.0) & (p[:, 1] > 10.0) & (p[:, 1] < 30.0))
+        self.assertEqual(self.index.query_polygon(SQUARE).tolist(), expected.tolist())
+        self.assertEqual(len(self.index.query_polygon(SQUARE[::-1])), 0)
+
+    def test_polygons_match_single_queries(self):
+        polygons = [SQUARE, [(x - 25.0, y - 40.0) for (x, y) in SQUARE]]
+        (indices, mask) = self.index.query_polygons(polygons)
+        for (polygon, row) in zip(polygons, mask):
+            self.assertEqual(indices[row].tolist(), self.index.query_polygon(polygon).tolist())
+
+    def test_oriented_rect_matches_local_frame(self):
+        (center, forward) = (np.array([5.0, -3.0]), np.array([1.0, 1.0]) / np.sqrt(2.0))
+        local = self.points - center
+        along = local.dot(forward)
+        across = local.dot([-forward[1], forward[0]])
+        expected = np.flatnonzero((np.abs(along) < 12.0) & (np.abs(across) < 4.0))
+        self.assertEqual(self.index.query_oriented_rect(center, forward, 12.0, 4.0).tolist(), expected.tolist())
+
+    def test_empty_index(self):
+        index = GridIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index.query_radius(0.0, 0.0, 10.0)), 0)
+        self.assertEqual(len(index.query_polygon(SQUARE)), 0)
+
+    def test_points_in_polygon(self):
+        mask = points_in_polygon([(20.0, 20.0), (10.0, 20.0), (35.0, 20.0)], SQUARE)
+        self.assertEqual(mask.tolist(), [True, False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()